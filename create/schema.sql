@@ -3,6 +3,7 @@ CREATE TABLE repository (
     name character varying UNIQUE NOT NULL,
     opened boolean DEFAULT TRUE,
     days BOOLEAN ARRAY[7] DEFAULT '{t,t,t,t,t,t,t}',
+    days_mask integer NOT NULL DEFAULT 127,
     latitude numeric(9,6) DEFAULT 0,
     longitude numeric(9,6) DEFAULT 0
 );
@@ -31,6 +32,7 @@ CREATE TABLE batch (
     id SERIAL PRIMARY KEY NOT NULL,
     date timestamp without time zone UNIQUE NOT NULL,
     capacity numeric(4,2) NOT NULL CHECK (capacity > 0),
+    load numeric(8,2) NOT NULL DEFAULT 0,
     opened boolean DEFAULT TRUE
 );
 
@@ -40,6 +42,7 @@ CREATE INDEX batch_date_index ON batch(date);
 CREATE TABLE order_ (
     id SERIAL PRIMARY KEY NOT NULL,
     total numeric(8,2) NOT NULL CHECK (total >= 0),
+    load numeric(8,2) NOT NULL DEFAULT 0,
     date timestamp without time zone DEFAULT NOW(),
     disabled boolean DEFAULT false,
     client_id integer REFERENCES client(id) NOT NULL,
@@ -47,6 +50,7 @@ CREATE TABLE order_ (
 );
 
 CREATE INDEX order_date_index ON order_(date);
+CREATE INDEX order_client_batch_index ON order_(client_id, batch_id);
 
 
 CREATE TABLE product (
@@ -67,3 +71,55 @@ CREATE TABLE order_product_association (
     product_id integer REFERENCES product(id) NOT NULL,
     PRIMARY KEY (order_id, product_id)
 );
+
+
+CREATE TABLE plan_summary (
+    batch_id integer REFERENCES batch(id) NOT NULL,
+    repository_id integer REFERENCES repository(id) NOT NULL,
+    client_id integer REFERENCES client(id) NOT NULL,
+    product_id integer REFERENCES product(id) NOT NULL,
+    quantity integer NOT NULL,
+    load numeric(8,2) NOT NULL,
+    PRIMARY KEY (batch_id, repository_id, client_id, product_id)
+);
+
+CREATE INDEX plan_summary_client_index ON plan_summary(client_id);
+
+
+CREATE TABLE mailing_job (
+    id SERIAL PRIMARY KEY NOT NULL,
+    subject character varying NOT NULL,
+    message text NOT NULL,
+    sender character varying NOT NULL,
+    repository_id integer REFERENCES repository(id),
+    status character varying NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'expanded')),
+    last_client_id integer NOT NULL DEFAULT 0,
+    recipients integer NOT NULL DEFAULT 0,
+    sent integer NOT NULL DEFAULT 0,
+    failed integer NOT NULL DEFAULT 0,
+    created_at timestamp without time zone NOT NULL DEFAULT NOW()
+);
+
+
+CREATE TABLE outbox (
+    id SERIAL PRIMARY KEY NOT NULL,
+    priority smallint NOT NULL,
+    recipients character varying[] NOT NULL,
+    message text NOT NULL,
+    status character varying NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'dead')),
+    attempts integer NOT NULL DEFAULT 0,
+    next_attempt timestamp without time zone NOT NULL DEFAULT NOW(),
+    last_error character varying,
+    created_at timestamp without time zone NOT NULL DEFAULT NOW(),
+    sent_at timestamp without time zone,
+    job_id integer REFERENCES mailing_job(id)
+);
+
+CREATE INDEX outbox_pending_index ON outbox(priority, id) WHERE status = 'pending';
+
+
+CREATE TABLE table_version (
+    name character varying PRIMARY KEY NOT NULL,
+    version integer NOT NULL DEFAULT 1,
+    changed_at timestamp with time zone NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import json
+import os
+import os.path as op
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = op.join(op.dirname(op.abspath(__file__)), "static")
+BUILD_DIR = op.join(STATIC_DIR, "build")
+MANIFEST = "manifest.json"
+
+EXTENSIONS = (
+    ".css", ".js", ".map", ".png", ".jpg", ".gif", ".svg", ".ico",
+    ".woff", ".woff2", ".ttf", ".eot"
+)
+COMPRESSED = (".css", ".js", ".map", ".svg", ".ico", ".ttf", ".eot")
+# smaller files are not worth compressing
+MIN_SIZE = 1024
+
+URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def load_manifest(build_dir=BUILD_DIR):
+    try:
+        with open(op.join(build_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def static_url(manifest):
+    """Return the static() helper of the templates
+
+    It returns the url of the fingerprinted copy of a file when the assets
+    have been built, and else the url of the file itself.
+    """
+    def static(path):
+        hashed = manifest.get(path)
+        if hashed is None:
+            return "/static/" + path
+        return "/static/build/" + hashed
+    return static
+
+
+def hashed_name(path, content):
+    root, ext = posixpath.splitext(path)
+    return "{}.{}{}".format(root, hashlib.md5(content).hexdigest()[:12], ext)
+
+
+def rewrite_css(path, content, manifest):
+    """Replace the relative urls of a stylesheet by those of the hashed files"""
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(("data:", "http:", "https:", "/", "#")):
+            return match.group(0)
+        target, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+        hashed = manifest.get(posixpath.normpath(posixpath.join(directory, target)))
+        if hashed is None:
+            return match.group(0)
+        return "url({0}{1}{2}{0})".format(quote, posixpath.relpath(hashed, directory), suffix)
+
+    return URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def write(path, content):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+    if path.endswith(COMPRESSED) and len(content) >= MIN_SIZE:
+        compressed = gzip.compress(content, 9, mtime=0)
+        if len(compressed) < len(content):
+            with open(path + ".gz", "wb") as f:
+                f.write(compressed)
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                with open(path + ".br", "wb") as f:
+                    f.write(compressed)
+
+
+def build_assets(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    """Write the fingerprinted and compressed copies of the static files
+
+    The manifest maps the paths of the files to the paths of their copies,
+    both relative to their directory. The stylesheets are written last, once
+    the urls of the files they refer to are known. The copies of the previous
+    build are kept, for the pages cached by the browsers that still refer to
+    them, the older ones are removed.
+    """
+    excluded = op.abspath(build_dir)
+    paths = []
+    for root, dirs, names in os.walk(static_dir):
+        dirs[:] = sorted(
+            d for d in dirs
+            if not d.startswith(".") and op.abspath(op.join(root, d)) != excluded
+        )
+        for name in names:
+            if name.endswith(EXTENSIONS):
+                paths.append(op.relpath(op.join(root, name), static_dir).replace(os.sep, "/"))
+    paths.sort(key=lambda path: (path.endswith(".css"), path))
+
+    previous = load_manifest(build_dir)
+    manifest = {}
+    for path in paths:
+        with open(op.join(static_dir, path), "rb") as f:
+            content = f.read()
+        if path.endswith(".css"):
+            content = rewrite_css(path, content, manifest)
+        manifest[path] = hashed_name(path, content)
+        write(op.join(build_dir, manifest[path]), content)
+
+    # the new files are used at once
+    os.makedirs(build_dir, exist_ok=True)
+    temporary_path = op.join(build_dir, MANIFEST + ".tmp")
+    with open(temporary_path, "w") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(temporary_path, op.join(build_dir, MANIFEST))
+
+    kept = set(manifest.values()) | set(previous.values())
+    for root, _, names in os.walk(build_dir):
+        for name in names:
+            path = op.relpath(op.join(root, name), build_dir).replace(os.sep, "/")
+            if path != MANIFEST and re.sub(r"\.(gz|br)$", "", path) not in kept:
+                os.remove(op.join(root, name))
+    return manifest
@@ -1,15 +1,36 @@
 from functools import wraps
 
 from aiohttp.web import HTTPForbidden
-from aiohttp_security import permits
+from aiohttp_security.api import AUTZ_KEY
+from aiohttp_security.api import IDENTITY_KEY
+
+
+def has_permission(client, permission):
+    if client is None or not client["confirmed"]:
+        return False
+    return client["super_user"] or permission == "client"
+
+
+async def principal_middleware(app, handler):
+    """Load the record of the authenticated client once per request"""
+    async def middleware_handler(request):
+        request["client"] = None
+        identity_policy = request.config_dict.get(IDENTITY_KEY)
+        if identity_policy is not None:
+            identity = await identity_policy.identify(request)
+            if identity is not None:
+                client = await request.config_dict[AUTZ_KEY].get_client(identity)
+                if client is not None and client["confirmed"]:
+                    request["client"] = client
+        return await handler(request)
+    return middleware_handler
 
 
 def require(permission):
     def wrapper(f):
         @wraps(f)
         async def wrapped(request):
-            has_perm = await permits(request, permission)
-            if not has_perm:
+            if not has_permission(request["client"], permission):
                 message = "User has no permission \"{}\"".format(permission)
                 raise HTTPForbidden(body=message)
             return await f(request)
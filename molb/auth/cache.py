@@ -0,0 +1,56 @@
+from time import monotonic
+
+from molb.etag import table_changed
+from molb.notify import notify
+
+
+CHANNEL = "client_changed"
+
+
+class ClientCache:
+    """Per worker cache of the client records used by the authorization policy
+
+    Unknown logins are cached as None. An empty or None login invalidates the
+    whole cache.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, login, load):
+        entry = self.entries.get(login)
+        if entry is not None and entry[0] > monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        generation = self.generation
+        client = await load(login)
+        # do not store a record that has been invalidated while it was loaded
+        if generation == self.generation:
+            self.entries[login] = (monotonic() + self.ttl, client)
+        return client
+
+    def invalidate(self, login=None):
+        self.generation += 1
+        if login:
+            self.entries.pop(login, None)
+        else:
+            self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+async def client_changed(request, conn, login):
+    """Invalidate the cached record of the client in all the workers
+
+    With a None login, all the records are invalidated.
+    """
+    request.app["client-cache"].invalidate(login)
+    await notify(conn, CHANNEL, login or "")
+    await table_changed(request, conn, "client")
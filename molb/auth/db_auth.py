@@ -1,40 +1,54 @@
 from aiohttp_security.abc import AbstractAuthorizationPolicy
-from passlib.hash import sha256_crypt
+
+from molb.auth import has_permission
 
 
 class DBAuthorizationPolicy(AbstractAuthorizationPolicy):
-    def __init__(self, db_pool):
+    def __init__(self, db_pool, client_cache):
         self.db_pool = db_pool
+        self.client_cache = client_cache
 
-    async def authorized_userid(self, identity):
+    async def load_client(self, login):
         async with self.db_pool.acquire() as conn:
-            q = "SELECT COUNT(*) FROM client WHERE login = $1 AND confirmed"
-            res = await conn.fetchval(q, identity, column=0)
-            if res:
-                return identity
-            else:
-                return None
+            q = (
+                "SELECT c.id, c.login, c.confirmed, c.disabled, c.super_user, c.mailing, "
+                "       c.first_name, c.last_name, c.email_address, c.phone_number, "
+                "       c.repository_id, r.days, r.days_mask "
+                "FROM client AS c "
+                "INNER JOIN repository AS r ON c.repository_id = r.id "
+                "WHERE c.login = $1"
+            )
+            return await conn.fetchrow(q, login)
+
+    async def get_client(self, identity):
+        return await self.client_cache.get(identity, self.load_client)
+
+    async def authorized_userid(self, identity):
+        client = await self.get_client(identity)
+        if client is not None and client["confirmed"]:
+            return identity
+        else:
+            return None
 
     async def permits(self, identity, permission, context=None):
         if identity is None:
             return False
 
-        async with self.db_pool.acquire() as conn:
-            q = "SELECT super_user FROM client WHERE login = $1 AND confirmed"
-            client = await conn.fetchrow(q, identity)
-            if client is not None:
-                if client["super_user"]:
-                    return True
-                if permission == "client":
-                    return True
-            return False
+        return has_permission(await self.get_client(identity), permission)
 
 
-async def check_credentials(db_pool, username, password):
+async def check_credentials(db_pool, hasher, username, password):
     async with db_pool.acquire() as conn:
         q = "SELECT password_hash FROM client WHERE login = $1 AND confirmed"
         client = await conn.fetchrow(q, username)
-    if client is not None:
-        hash_ = client["password_hash"]
-        return sha256_crypt.verify(password, hash_)
-    return False
+    if client is None:
+        return False
+
+    hash_ = client["password_hash"]
+    valid, new_hash = await hasher.verify_and_update(password, hash_)
+    if valid and new_hash is not None:
+        # the hash has been computed with an outdated cost
+        async with db_pool.acquire() as conn:
+            q = "UPDATE client SET password_hash = $1 WHERE login = $2 AND password_hash = $3"
+            await conn.execute(q, new_hash, username, hash_)
+    return valid
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from aiohttp.web import HTTPServiceUnavailable
+from passlib.context import CryptContext
+
+
+def crypt_context(rounds):
+    # hashes having less rounds than required are flagged as needing an update
+    return CryptContext(
+        schemes=["sha256_crypt"],
+        sha256_crypt__default_rounds=rounds,
+        sha256_crypt__min_rounds=rounds
+    )
+
+
+# these functions run in the worker processes of the pool
+
+@lru_cache()
+def _context(rounds):
+    return crypt_context(rounds)
+
+
+def _hash(rounds, password):
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(rounds, password, hash_):
+    return _context(rounds).verify_and_update(password, hash_)
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a process pool
+
+    At most `concurrency` computations are submitted to the pool at once and
+    at most `max_queue` others wait for their turn, further requests are
+    rejected with a 503 error instead of piling up.
+    """
+
+    def __init__(self, processes=2, concurrency=2, max_queue=16, rounds=535000):
+        self.rounds = rounds
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pending = 0
+
+    async def run(self, func, *args):
+        if self.pending >= self.concurrency + self.max_queue:
+            raise HTTPServiceUnavailable()
+
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(self.executor, func, self.rounds, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self.run(_hash, password)
+
+    async def verify_and_update(self, password, hash_):
+        """Return (valid, new_hash), new_hash is None if the hash is up to date"""
+        return await self.run(_verify_and_update, password, hash_)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,100 @@
+import asyncio
+
+from molb.etag import table_changed
+from molb.notify import notify
+
+
+CHANNEL = "catalog_changed"
+
+LOCALES = ("fr", "en")
+
+
+def products_for_context(rows, locale):
+    p = {}
+    for r in rows:
+        dct = dict(r)
+        n = dct.pop("name_lang1")
+        d = dct.pop("description_lang1")
+        if str(locale) == 'en':
+            dct["name"] = n
+            dct["description"] = d
+        p[dct["id"]] = dct
+    return p
+
+
+class Catalog:
+    """Per worker cache of the reference data used by the ordering pages
+
+    It holds the available products, already translated for each locale, the
+    opened repositories and the opened batches to come. A table is loaded on
+    first use after it has been invalidated, its version is incremented each
+    time it is loaded.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.data = {}
+        self.versions = {"product": 0, "repository": 0, "batch": 0}
+        self.generations = {"product": 0, "repository": 0, "batch": 0}
+        self.lock = asyncio.Lock()
+
+    def invalidate(self, table=None):
+        for t in self.generations:
+            if not table or table == t:
+                self.generations[t] += 1
+                self.data.pop(t, None)
+
+    async def load_product(self, conn):
+        rows = await conn.fetch("SELECT * FROM product WHERE available ORDER BY id")
+        return {locale: products_for_context(rows, locale) for locale in LOCALES}
+
+    async def load_repository(self, conn):
+        q = (
+            "SELECT id, name, latitude, longitude, days FROM repository "
+            "WHERE opened ORDER BY name"
+        )
+        return await conn.fetch(q)
+
+    async def load_batch(self, conn):
+        q = (
+            "SELECT id, date, capacity FROM batch "
+            "WHERE opened AND date > NOW() ORDER BY date"
+        )
+        return {row["id"]: row for row in await conn.fetch(q)}
+
+    async def get(self, table):
+        data = self.data.get(table)
+        if data is not None:
+            return data
+
+        async with self.lock:
+            data = self.data.get(table)
+            if data is None:
+                generation = self.generations[table]
+                async with self.db_pool.acquire() as conn:
+                    data = await getattr(self, "load_" + table)(conn)
+                # do not store data that has been invalidated while it was loaded
+                if generation == self.generations[table]:
+                    self.data[table] = data
+                    self.versions[table] += 1
+        return data
+
+    async def products(self, locale):
+        """Return copies of the available products by id, translated for the locale"""
+        products = await self.get("product")
+        products = products.get(str(locale), products[LOCALES[0]])
+        return {id_: dict(product) for id_, product in products.items()}
+
+    async def repositories(self):
+        return await self.get("repository")
+
+    async def batches(self):
+        """Return the opened batches by id, some of them may be past now"""
+        return await self.get("batch")
+
+
+async def catalog_changed(request, conn, table):
+    """Invalidate the table of the catalog in all the workers"""
+    request.app["catalog"].invalidate(table)
+    await notify(conn, CHANNEL, table)
+    await table_changed(request, conn, table)
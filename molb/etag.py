@@ -0,0 +1,186 @@
+from datetime import datetime
+from datetime import timezone
+from functools import wraps
+import hashlib
+import os
+import os.path as op
+
+from aiohttp.web import HTTPNotModified
+from aiohttp_babel.middlewares import get_current_locale
+
+from molb.assets import BUILD_DIR
+from molb.assets import MANIFEST
+from molb.notify import notify
+from molb.pool import replica_lag
+from molb.post_commit import post_commit
+from molb.pool import wrote
+
+
+CHANNEL = "table_changed"
+
+
+def code_version():
+    """Return the date of the last change of the code or of the templates
+
+    The manifest of the static files is included, the pages refer to the
+    fingerprinted copies it lists.
+    """
+    directory = op.dirname(op.abspath(__file__))
+    version = str(max(
+        op.getmtime(op.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.endswith((".py", ".html", ".mo"))
+    ))
+    try:
+        with open(op.join(BUILD_DIR, MANIFEST), "rb") as f:
+            version += " " + hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        pass
+    return version
+
+
+# the cached pages are outdated after a deployment
+CODE_VERSION = code_version()
+
+
+class TableVersions:
+    """Per worker copy of the versions of the tables shown by the pages
+
+    The versions are loaded on first use, then kept up to date by the
+    notifications sent when a table is changed, so checking the tag of a page
+    does not query the database. The version of a table changed by the worker
+    itself is loaded again.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.versions = {}
+        self.generation = 0
+
+    def on_notification(self, payload):
+        if not payload:
+            # notifications may have been missed
+            self.invalidate()
+            return
+        name, version, changed_at = payload.split()
+        current = self.versions.get(name)
+        if current is None:
+            # a load in progress may have read the previous version
+            self.invalidate(name)
+        elif int(version) > current[0]:
+            changed_at = datetime.fromtimestamp(float(changed_at), timezone.utc)
+            self.versions[name] = (int(version), changed_at)
+
+    def invalidate(self, name=None):
+        self.generation += 1
+        if name:
+            self.versions.pop(name, None)
+        else:
+            self.versions.clear()
+
+    async def get(self, names):
+        """Return the version and the modification date of the tables"""
+        if any(name not in self.versions for name in names):
+            generation = self.generation
+            async with self.db_pool.acquire() as conn:
+                q = "SELECT name, version, changed_at FROM table_version WHERE name = any($1::text[])"
+                rows = await conn.fetch(q, list(names))
+            versions = {name: (0, None) for name in names}
+            versions.update({row["name"]: (row["version"], row["changed_at"]) for row in rows})
+            # do not store versions that have been invalidated while they were loaded
+            if generation == self.generation:
+                self.versions.update(versions)
+            return [versions[name] for name in names]
+        return [self.versions[name] for name in names]
+
+
+async def table_changed(request, conn, name):
+    """Change the version of the table in all the workers, once committed
+
+    The row of the table in table_version is updated after the commit, in a
+    transaction of its own, so that the writes to the same table do not wait
+    for each other on it. A change rolled back by a view that succeeds anyway
+    only costs the pages a new rendering.
+    """
+    changed = request.setdefault("changed-tables", set())
+    if name not in changed:
+        changed.add(name)
+        post_commit(request, increment_version, request.app, name)
+    await wrote(request)
+
+
+async def increment_version(app, name):
+    async with app["db-pool"].acquire() as conn:
+        async with conn.transaction():
+            q = (
+                "INSERT INTO table_version (name) VALUES ($1) "
+                "ON CONFLICT (name) DO UPDATE "
+                "SET version = table_version.version + 1, changed_at = NOW() "
+                "RETURNING version, EXTRACT(EPOCH FROM changed_at)"
+            )
+            version, changed_at = await conn.fetchrow(q, name)
+            await notify(conn, CHANNEL, "{} {} {}".format(name, version, changed_at))
+    app["table-versions"].invalidate(name)
+
+
+def etag(*tables, until=None):
+    """Answer 304 to a GET when the page would be the same as the cached one
+
+    The tag depends on the versions of the tables shown by the page, on the
+    client, on the locale and, for the pages that depend on the time, on the
+    date at which they change next, returned by the until coroutine. That date
+    is kept by client, and only asked again once it is passed or once the
+    tables have changed. The pages that display pending flash messages are not
+    tagged, nor the pages read from the replica that may not have the last
+    changes yet.
+    """
+    def wrapper(f):
+        # client login -> versions of the tables, date of the next change
+        deadlines = {}
+
+        @wraps(f)
+        async def wrapped(request):
+            if request.method != "GET" or request.get("flash"):
+                return await f(request)
+
+            versions = await request.app["table-versions"].get(tables)
+            client = request.get("client")
+            login = client["login"] if client is not None else ""
+            deadline = None
+            if until is not None:
+                cached = deadlines.get(login)
+                if (
+                    cached is not None and cached[0] == versions and
+                    (cached[1] is None or datetime.now() < cached[1])
+                ):
+                    deadline = cached[1]
+                else:
+                    deadline = await until(request)
+                    deadlines[login] = (versions, deadline)
+            parts = [
+                CODE_VERSION,
+                request.path,
+                login,
+                str(get_current_locale()),
+                str(deadline) if deadline is not None else ""
+            ]
+            parts.extend(str(version) for version, _ in versions)
+            tag = hashlib.sha1("\n".join(parts).encode()).hexdigest()[:20]
+            dates = [changed_at for _, changed_at in versions if changed_at is not None]
+
+            if any(e.value in (tag, "*") for e in request.if_none_match or ()):
+                response = HTTPNotModified()
+            else:
+                response = await f(request)
+                if request.get("replica") and dates:
+                    age = datetime.now(timezone.utc) - max(dates)
+                    if age.total_seconds() < replica_lag(request.app):
+                        return response
+            response.etag = tag
+            if dates:
+                response.last_modified = max(dates)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return wrapped
+    return wrapper
@@ -0,0 +1,162 @@
+import heapq
+import math
+
+
+EARTH_RADIUS = 6371.0  # km
+KM_BY_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Return the great circle distance in km between two positions"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def feature(lat, lon, **properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": properties
+    }
+
+
+class GridIndex:
+    """Points bucketed in the cells of a regular grid of latitudes and longitudes
+
+    The points are dicts holding at least their latitude and longitude.
+    """
+
+    def __init__(self, points, cell_size=0.1):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+        for point in points:
+            point = dict(point, latitude=float(point["latitude"]), longitude=float(point["longitude"]))
+            self.cells.setdefault(self.cell(point["latitude"], point["longitude"]), []).append(point)
+            self.size += 1
+        # bounds of the cells holding points
+        if self.cells:
+            self.bounds = (
+                min(i for i, _ in self.cells), min(j for _, j in self.cells),
+                max(i for i, _ in self.cells), max(j for _, j in self.cells)
+            )
+
+    def cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def within(self, south, west, north, east):
+        """Return the points of the bounding box"""
+        (s, w), (n, e) = self.cell(south, west), self.cell(north, east)
+        if (n - s + 1) * (e - w + 1) > len(self.cells):
+            cells = self.cells.values()
+        else:
+            cells = [
+                self.cells[(i, j)]
+                for i in range(s, n + 1) for j in range(w, e + 1)
+                if (i, j) in self.cells
+            ]
+        return [
+            point for points in cells for point in points
+            if south <= point["latitude"] <= north and west <= point["longitude"] <= east
+        ]
+
+    def ring(self, center, radius):
+        """Return the points of the cells at the given distance in cells of the center"""
+        i0, j0 = center
+        if radius == 0:
+            return list(self.cells.get(center, ()))
+        cells = []
+        for j in range(j0 - radius, j0 + radius + 1):
+            cells.append((i0 - radius, j))
+            cells.append((i0 + radius, j))
+        for i in range(i0 - radius + 1, i0 + radius):
+            cells.append((i, j0 - radius))
+            cells.append((i, j0 + radius))
+        return [point for cell in cells for point in self.cells.get(cell, ())]
+
+    def nearest(self, lat, lon, k):
+        """Return the k nearest points with their distance in km, nearest first
+
+        The rings of cells around the position are searched until the points
+        found are closer than any point of the cells not searched yet. When
+        the position is outside of the cells holding points, or when the rings
+        would hold more cells than the grid, all the points are compared.
+        """
+        if not self.cells:
+            return []
+        center = self.cell(lat, lon)
+        s, w, n, e = self.bounds
+        if not (s <= center[0] <= n and w <= center[1] <= e):
+            return self.scan(lat, lon, k)
+        max_radius = max(center[0] - s, n - center[0], center[1] - w, e - center[1])
+
+        found = []
+        for radius in range(max_radius + 1):
+            if (2 * radius + 1) ** 2 > 4 * len(self.cells):
+                return self.scan(lat, lon, k)
+            points = self.ring(center, radius)
+            found.extend(
+                (distance(lat, lon, p["latitude"], p["longitude"]), p) for p in points
+            )
+            found.sort(key=lambda f: f[0])
+            del found[k:]
+
+            # the cells not searched yet are at least radius cells away, the
+            # longitudes being the closest where the latitude is the highest
+            highest = min(90, abs(lat) + (radius + 1) * self.cell_size)
+            bound = radius * self.cell_size * KM_BY_DEGREE * math.cos(math.radians(highest))
+            if len(found) == k and found[-1][0] <= bound:
+                break
+        return found
+
+    def scan(self, lat, lon, k):
+        """Return the k nearest points compared one by one"""
+        return heapq.nsmallest(k, (
+            (distance(lat, lon, p["latitude"], p["longitude"]), p)
+            for points in self.cells.values() for p in points
+        ), key=lambda f: f[0])
+
+    def clusters(self, south, west, north, east, cell_size):
+        """Return the points of the bounding box grouped by cells of the given size
+
+        A group is a tuple of the mean latitude and longitude of its points and
+        of its points.
+        """
+        groups = {}
+        for point in self.within(south, west, north, east):
+            key = (
+                math.floor(point["latitude"] / cell_size),
+                math.floor(point["longitude"] / cell_size)
+            )
+            groups.setdefault(key, []).append(point)
+        return [
+            (
+                sum(p["latitude"] for p in points) / len(points),
+                sum(p["longitude"] for p in points) / len(points),
+                points
+            )
+            for points in groups.values()
+        ]
+
+
+class RepositoryIndex:
+    """Per worker index of the opened repositories
+
+    It is rebuilt when the repositories of the catalog have been reloaded.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.rows = None
+        self.index = None
+
+    async def get(self):
+        rows = await self.catalog.repositories()
+        if rows is not self.rows:
+            self.index = GridIndex(rows)
+            self.rows = rows
+        return self.index
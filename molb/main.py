@@ -3,36 +3,42 @@
 import asyncio
 import base64
 import os
-import os.path as op
 
 from aiohttp import web
-from aiohttp_babel.locale import load_gettext_translations
-from aiohttp_babel.locale import set_default_locale
-from aiohttp_babel.middlewares import _
 from aiohttp_babel.middlewares import babel_middleware
-import aiohttp_jinja2
 from aiohttp_session import setup as session_setup
-from aiohttp_security import authorized_userid
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 from aiohttp_security import SessionIdentityPolicy
 from aiohttp_security import setup as setup_security
 import aiohttp_session_flash
-from asyncpg import create_pool
-from jinja2 import FileSystemLoader
 
+from molb.auth import principal_middleware
+from molb.auth.cache import CHANNEL as CLIENT_CHANNEL
+from molb.auth.cache import ClientCache
 from molb.auth.db_auth import DBAuthorizationPolicy
+from molb.auth.hashing import PasswordHasher
+from molb.catalog import CHANNEL as CATALOG_CHANNEL
+from molb.catalog import Catalog
 from molb.error import error_middleware
+from molb.etag import CHANNEL as TABLE_CHANNEL
+from molb.etag import TableVersions
+from molb.geo import RepositoryIndex
+from molb.notify import Listener
+from molb.plan import CHANNEL as PLAN_CHANNEL
+from molb.plan import PlanCache
+from molb.pool import create_pool
+from molb.pool import has_replica
+from molb.pool import session_dsn
+from molb.pool import session_options
+from molb.post_commit import post_commit_middleware
 from molb.routes import setup_routes
+from molb.templating import setup_i18n
+from molb.templating import setup_templates
+from molb.tiles import TileCache
 from molb.views.send_message import MassMailer
 from molb.utils import read_configuration_file
 
 
-def setup_i18n():
-    set_default_locale("fr")
-    locales_dir = op.join(op.dirname(op.abspath(__file__)), "locales", "translations")
-    load_gettext_translations(locales_dir, "messages")
-
-
 def setup_session(app):
     # use the same session key for all instances of the application
     # as gunicorn can create more than one
@@ -44,32 +50,115 @@ def setup_session(app):
 async def attach_db(config):
     config["database"]["password"] = os.getenv("PG_PASS", "") or config["database"]["password"]
 
-    dsn = "postgres://{}:{}@{}:{}/{}".format(
-        config["database"]["username"], config["database"]["password"],
-        config["database"]["host"], config["database"]["port"],
-        config["database"]["database"]
-    )
-    return await create_pool(dsn=dsn)
+    return await create_pool(config["database"])
+
+
+async def attach_replica_db(config):
+    replica = config["database_replica"]
+    # the replica is reached with the settings of the primary it does not override
+    for key, value in config["database"].items():
+        replica.setdefault(key, value)
+    replica["password"] = os.getenv("PG_REPLICA_PASS", "") or replica["password"]
+
+    return await create_pool(replica)
 
 
 async def startup(app):
-    db_pool = await attach_db(app["config"])
+    config = app["config"]
+
+    db_pool = await attach_db(config)
     app["db-pool"] = db_pool
+    # the read only views run on the replica, if any
+    if config.has_section("database_replica"):
+        app["db-replica-pool"] = await attach_replica_db(config)
+    else:
+        app["db-replica-pool"] = db_pool
+
+    # notifications sent by the workers for invalidating their caches
+    app["listener"] = Listener(
+        session_dsn(config["database"]),
+        connect_options=session_options(config["database"])
+    )
+    await app["listener"].connect()
+
+    app["hasher"] = PasswordHasher(
+        processes=config.getint("hashing", "processes", fallback=2),
+        concurrency=config.getint("hashing", "concurrency", fallback=2),
+        max_queue=config.getint("hashing", "max_queue", fallback=16),
+        rounds=config.getint("hashing", "rounds", fallback=535000)
+    )
+
+    # the messages are sent from the outbox by a single elected worker
+    app["mailer"] = MassMailer(
+        db_pool,
+        session_dsn(config["database"]),
+        app["listener"],
+        host=config.get("smtp", "host", fallback="127.0.0.1"),
+        port=config.getint("smtp", "port", fallback=25),
+        use_tls=config.getboolean("smtp", "use_tls", fallback=False),
+        start_tls=config.getboolean("smtp", "start_tls", fallback=False),
+        username=config.get("smtp", "username", fallback=None),
+        password=config.get("smtp", "password", fallback=None),
+        pool_size=config.getint("smtp", "pool_size", fallback=5),
+        max_messages=config.getint("smtp", "max_messages", fallback=100),
+        idle_timeout=config.getint("smtp", "idle_timeout", fallback=30),
+        batch_size=config.getint("outbox", "batch_size", fallback=50),
+        max_attempts=config.getint("outbox", "max_attempts", fallback=5),
+        retry_delay=config.getint("outbox", "retry_delay", fallback=60),
+        poll_interval=config.getint("outbox", "poll_interval", fallback=10),
+        keep_days=config.getint("outbox", "keep_days", fallback=7),
+        job_chunk=config.getint("outbox", "job_chunk", fallback=500),
+        max_recipients=config.getint("outbox", "max_recipients", fallback=50),
+        connect_options=session_options(config["database"])
+    )
+    await app["mailer"].start()
+
+    client_cache = ClientCache(config.getint("cache", "client_ttl", fallback=60))
+    app["client-cache"] = client_cache
+    await app["listener"].listen(CLIENT_CHANNEL, client_cache.invalidate)
+
+    catalog = Catalog(db_pool)
+    app["catalog"] = catalog
+    await app["listener"].listen(CATALOG_CHANNEL, catalog.invalidate)
+    app["repository-index"] = RepositoryIndex(catalog)
+
+    # the tiles of the map are served from a local cache
+    app["tile-cache"] = TileCache.from_config(config)
+    await app["tile-cache"].start()
+
+    # versions of the tables the tags of the cached pages depend on
+    table_versions = TableVersions(db_pool)
+    app["table-versions"] = table_versions
+    await app["listener"].listen(TABLE_CHANNEL, table_versions.on_notification)
+
+    # the plans also hold the names of the clients, products and repositories
+    # room for the batches of a report and for the last batches of the plan page
+    plan_cache = PlanCache(config.getint("plan", "report_max_batches", fallback=31) + 10)
+    app["plan-cache"] = plan_cache
+    await app["listener"].listen(PLAN_CHANNEL, plan_cache.invalidate)
+    await app["listener"].listen(CLIENT_CHANNEL, lambda payload: plan_cache.invalidate())
+    await app["listener"].listen(CATALOG_CHANNEL, lambda payload: plan_cache.invalidate())
 
     setup_security(
         app,
         SessionIdentityPolicy(),
-        DBAuthorizationPolicy(db_pool)
+        DBAuthorizationPolicy(db_pool, client_cache)
     )
 
 
 async def cleanup(app):
+    await app["listener"].close()
+    if has_replica(app):
+        await app["db-replica-pool"].close()
     await app["db-pool"].close()
-    app["mailer"].close()
+    app["hasher"].close()
+    await app["mailer"].close()
+    await app["tile-cache"].close()
 
 
 async def authorized_userid_context_processor(request):
-    return {"authorized_userid": await authorized_userid(request)}
+    client = request.get("client")
+    return {"authorized_userid": client["login"] if client is not None else None}
 
 
 async def create_app():
@@ -78,23 +167,19 @@ async def create_app():
     app = web.Application(middlewares=[error_middleware, babel_middleware])
     app["config"] = config
 
-    app["mailer"] = MassMailer()
-
     # beware of order !
     setup_session(app)
     app.middlewares.append(aiohttp_session_flash.middleware)
+    app.middlewares.append(principal_middleware)
+    app.middlewares.append(post_commit_middleware)
 
-    template_dir = op.join(op.dirname(op.abspath(__file__)), "templates")
-    aiohttp_jinja2.setup(
+    setup_templates(
         app,
-        loader=FileSystemLoader(template_dir),
         context_processors=(
             aiohttp_session_flash.context_processor,
             authorized_userid_context_processor
         )
     )
-    jinja2_env = aiohttp_jinja2.get_env(app)
-    jinja2_env.globals['_'] = _
 
     setup_routes(app)
 
@@ -0,0 +1,188 @@
+"""Apply the migrations of the database that have not been applied yet
+
+The migrations are the numbered SQL files of the migrations directory, applied
+in the order of their numbers, each one in a transaction with the record of
+its number in the schema_version table. The files holding a
+"-- no-transaction" line are run statement by statement outside of any
+transaction, as CREATE INDEX CONCURRENTLY requires it. The "-- explain:" lines
+of a file give the queries whose plans are shown before and after the
+migration with --explain.
+
+usage: molb-migrate [--list] [--explain]
+"""
+import asyncio
+import os
+import os.path as op
+import re
+import sys
+
+import asyncpg
+
+from molb.pool import session_dsn
+from molb.pool import session_options
+from molb.utils import read_configuration_file
+
+
+MIGRATIONS_DIR = op.join(op.dirname(op.abspath(__file__)), "migrations")
+FILENAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.I
+)
+# only one runner at a time applies the migrations
+LOCK_ID = 0x6d6f6c62
+
+SCHEMA_VERSION = (
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "    version integer PRIMARY KEY NOT NULL,"
+    "    name character varying NOT NULL,"
+    "    applied_at timestamp with time zone NOT NULL DEFAULT NOW()"
+    ")"
+)
+
+
+class Migration:
+
+    def __init__(self, path):
+        self.path = path
+        version, self.name = FILENAME.match(op.basename(path)).groups()
+        self.version = int(version)
+        with open(path) as f:
+            self.sql = f.read()
+        lines = [line.strip() for line in self.sql.splitlines()]
+        self.transaction = "-- no-transaction" not in lines
+        self.explain = [
+            line[len("-- explain:"):].strip() for line in lines if line.startswith("-- explain:")
+        ]
+
+    def statements(self):
+        """Return the statements of the file, ended by a semicolon at the end of a line"""
+        sql = "\n".join(
+            line for line in self.sql.splitlines() if not line.strip().startswith("--")
+        )
+        return [s.strip() for s in re.split(r";\s*$", sql, flags=re.M) if s.strip()]
+
+    def indexes(self):
+        """Return the names of the indexes built concurrently"""
+        return [
+            m.group(1) for statement in self.statements()
+            for m in [CONCURRENT_INDEX.match(statement)] if m
+        ]
+
+    def __str__(self):
+        return "{:04d}_{}".format(self.version, self.name)
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = [
+        Migration(op.join(directory, name))
+        for name in os.listdir(directory) if FILENAME.match(name)
+    ]
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError("two migrations have the same number in {}".format(directory))
+    return migrations
+
+
+async def explain(conn, queries):
+    """Print the plans of the queries, which are run then rolled back"""
+    for q in queries:
+        print("    " + q)
+        tr = conn.transaction()
+        await tr.start()
+        try:
+            rows = await conn.fetch("EXPLAIN (ANALYZE, BUFFERS) " + q)
+        finally:
+            await tr.rollback()
+        for row in rows:
+            print("        " + row[0])
+
+
+async def apply(conn, migration):
+    if migration.transaction:
+        async with conn.transaction():
+            await conn.execute(migration.sql)
+            await conn.execute(
+                "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                migration.version, migration.name
+            )
+        return
+
+    # a failed concurrent build leaves an invalid index behind, that IF NOT
+    # EXISTS would keep
+    q = (
+        "SELECT c.relname FROM pg_index AS i "
+        "INNER JOIN pg_class AS c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND c.relname = any($1::text[])"
+    )
+    for row in await conn.fetch(q, migration.indexes()):
+        print("  dropping the invalid index {}".format(row[0]))
+        await conn.execute('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(row[0]))
+
+    for statement in migration.statements():
+        await conn.execute(statement)
+
+    invalid = [row[0] for row in await conn.fetch(q, migration.indexes())]
+    if invalid:
+        raise RuntimeError("invalid indexes {}".format(", ".join(invalid)))
+    await conn.execute(
+        "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+        migration.version, migration.name
+    )
+
+
+async def migrate(conn, migrations, list_only=False, explain_plans=False):
+    """Apply the pending migrations, return their number"""
+    await conn.execute("SELECT pg_advisory_lock($1)", LOCK_ID)
+    try:
+        await conn.execute(SCHEMA_VERSION)
+        applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_version")}
+        pending = [m for m in migrations if m.version not in applied]
+
+        for migration in pending:
+            print(migration)
+            if list_only:
+                continue
+            if explain_plans and migration.explain:
+                print("  before:")
+                await explain(conn, migration.explain)
+            await apply(conn, migration)
+            if explain_plans and migration.explain:
+                # the planner needs the statistics of the new indexes
+                await conn.execute("ANALYZE")
+                print("  after:")
+                await explain(conn, migration.explain)
+        return len(pending)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_ID)
+
+
+async def run(config, list_only, explain_plans):
+    # the advisory lock and the concurrent builds need a session
+    conn = await asyncpg.connect(session_dsn(config), **session_options(config))
+    try:
+        count = await migrate(conn, load_migrations(), list_only, explain_plans)
+    finally:
+        await conn.close()
+    if list_only:
+        print("{} pending migrations".format(count))
+    else:
+        print("{} migrations applied".format(count))
+    return 0
+
+
+def main():
+    config = read_configuration_file()
+    if not config:
+        sys.exit(1)
+    config = config["database"]
+    config["password"] = os.getenv("PG_PASS", "") or config["password"]
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(
+        run(config, "--list" in sys.argv[1:], "--explain" in sys.argv[1:])
+    ))
+
+
+if __name__ == "__main__":
+    main()
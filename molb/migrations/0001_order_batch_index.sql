@@ -0,0 +1,6 @@
+-- orders of a batch: plans, batch loads and the check of the foreign key when
+-- a batch is deleted; order_client_batch_index only serves the lookups by
+-- client
+-- no-transaction
+-- explain: SELECT COUNT(*) FROM order_ WHERE batch_id = (SELECT MAX(id) FROM batch)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS order_batch_index ON order_(batch_id);
@@ -0,0 +1,5 @@
+-- clients of a repository: mailings, by pages of ids, and the check of the
+-- foreign key when a repository is deleted
+-- no-transaction
+-- explain: SELECT id FROM client WHERE repository_id = (SELECT MAX(id) FROM repository) AND id > 0 ORDER BY id LIMIT 500
+CREATE INDEX CONCURRENTLY IF NOT EXISTS client_repository_index ON client(repository_id, id);
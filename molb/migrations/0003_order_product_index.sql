@@ -0,0 +1,5 @@
+-- orders of a product: check of the foreign key when a product is deleted,
+-- the primary key only serves the lookups by order
+-- no-transaction
+-- explain: SELECT COUNT(*) FROM order_product_association WHERE product_id = (SELECT MAX(id) FROM product)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS order_product_product_index ON order_product_association(product_id);
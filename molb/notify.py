@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+import asyncpg
+
+
+logger = logging.getLogger(__name__)
+
+
+async def notify(conn, channel, payload=""):
+    """Send a notification to all the workers, delivered at commit time"""
+    await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+
+class Listener:
+    """Dedicated connection receiving the notifications sent by all workers
+
+    Callbacks are called with the payload of the notification. When the
+    connection is lost, notifications may have been missed so all callbacks
+    are called with None before reconnecting.
+    """
+
+    def __init__(self, dsn, retry_delay=5, connect_options=None):
+        self.dsn = dsn
+        self.connect_options = connect_options or {}
+        self.retry_delay = retry_delay
+        self.conn = None
+        self.callbacks = {}
+        self.reconnect_task = None
+
+    async def connect(self):
+        self.conn = await asyncpg.connect(self.dsn, **self.connect_options)
+        self.conn.add_termination_listener(self.on_termination)
+        for channel in self.callbacks:
+            await self.conn.add_listener(channel, self.dispatch)
+
+    async def listen(self, channel, callback):
+        if channel not in self.callbacks:
+            self.callbacks[channel] = []
+            if self.conn is not None:
+                await self.conn.add_listener(channel, self.dispatch)
+        self.callbacks[channel].append(callback)
+
+    def dispatch(self, conn, pid, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            callback(payload)
+
+    def on_termination(self, conn):
+        for callbacks in self.callbacks.values():
+            for callback in callbacks:
+                callback(None)
+        self.conn = None
+        self.reconnect_task = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        while self.conn is None:
+            await asyncio.sleep(self.retry_delay)
+            try:
+                await self.connect()
+            except Exception:
+                logger.exception("cannot reconnect the notification listener")
+
+    async def close(self):
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            conn.remove_termination_listener(self.on_termination)
+            await conn.close()
@@ -0,0 +1,118 @@
+from molb.etag import table_changed
+from molb.notify import notify
+
+
+CHANNEL = "order_changed"
+
+
+def rollup_plan(rows):
+    """Compute all the levels of the production plan from its detail
+
+    The rows hold the quantity and the load of a product ordered by a client
+    of a repository, sorted by repository, client and product names.
+    """
+    products = {}
+    products_by_repository = {}
+    load = 0
+    for row in rows:
+        quantity = row["quantity"]
+        name = row["product_name"]
+        products[name] = products.get(name, 0) + quantity
+        key = (row["repository_name"], name)
+        products_by_repository[key] = products_by_repository.get(key, 0) + quantity
+        load += row["load"]
+
+    return {
+        "load": load,
+        "products": [
+            {"name": name, "quantity": quantity}
+            for name, quantity in sorted(products.items())
+        ],
+        "products_by_repository": [
+            {"repository_name": repository_name, "product_name": product_name, "quantity": quantity}
+            for (repository_name, product_name), quantity in sorted(products_by_repository.items())
+        ],
+        "products_by_repository_by_client": [dict(row) for row in rows],
+    }
+
+
+class PlanCache:
+    """Per worker cache of the production plans of the last batches
+
+    A plan is computed from a single fetch of the summary of the orders of
+    the batch, it is kept until an order on the batch changes.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.plans = {}
+        self.generation = 0
+
+    def invalidate(self, batch_id=None):
+        self.generation += 1
+        if batch_id:
+            self.plans.pop(int(batch_id), None)
+        else:
+            self.plans.clear()
+
+    async def load(self, conn, batch_id):
+        q = (
+            "SELECT r.name AS repository_name, c.last_name, c.first_name, "
+            "       p.name AS product_name, s.quantity, s.load "
+            "FROM plan_summary AS s "
+            "INNER JOIN product AS p ON s.product_id = p.id "
+            "INNER JOIN client AS c ON s.client_id = c.id "
+            "INNER JOIN repository AS r ON s.repository_id = r.id "
+            "WHERE s.batch_id = $1 "
+            "ORDER BY r.name, c.last_name, c.first_name, p.name"
+        )
+        plan = rollup_plan(await conn.fetch(q, batch_id))
+        capacity = await conn.fetchval("SELECT capacity FROM batch WHERE id = $1", batch_id)
+        plan["batch"] = {"id": batch_id, "capacity": capacity, "load": plan["load"]}
+        return plan
+
+    async def get(self, conn, batch_id):
+        plan = self.plans.pop(batch_id, None)
+        if plan is not None:
+            # the least recently used plans are removed first
+            self.plans[batch_id] = plan
+        else:
+            generation = self.generation
+            plan = await self.load(conn, batch_id)
+            # do not store a plan that has been invalidated while it was loaded
+            if generation == self.generation:
+                if len(self.plans) >= self.size:
+                    del self.plans[next(iter(self.plans))]
+                self.plans[batch_id] = plan
+        return plan
+
+
+async def add_plan_lines(conn, batch_id, client_id, lines):
+    """Add the quantities by product id to the plan summary of the batch
+
+    Quantities are negative for removing products, must be called in the
+    transaction of the order. The repository of the client is read, and kept
+    from being changed, in this transaction.
+    """
+    q = (
+        "INSERT INTO plan_summary "
+        "    (batch_id, repository_id, client_id, product_id, quantity, load) "
+        "SELECT $1, c.repository_id, c.id, l.product_id, l.quantity, l.quantity * p.load "
+        "FROM unnest($3::int[], $4::int[]) AS l(product_id, quantity) "
+        "INNER JOIN product AS p ON p.id = l.product_id "
+        "INNER JOIN client AS c ON c.id = $2 "
+        "FOR SHARE OF c "
+        "ON CONFLICT (batch_id, repository_id, client_id, product_id) DO UPDATE "
+        "SET quantity = plan_summary.quantity + EXCLUDED.quantity, "
+        "    load = plan_summary.load + EXCLUDED.load"
+    )
+    await conn.execute(q, batch_id, client_id, list(lines.keys()), list(lines.values()))
+    q = "DELETE FROM plan_summary WHERE batch_id = $1 AND client_id = $2 AND quantity = 0"
+    await conn.execute(q, batch_id, client_id)
+
+
+async def order_changed(request, conn, batch_id):
+    """Invalidate the plan of the batch in all the workers"""
+    request.app["plan-cache"].invalidate(batch_id)
+    await notify(conn, CHANNEL, str(batch_id))
+    await table_changed(request, conn, "order_")
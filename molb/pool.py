@@ -0,0 +1,170 @@
+import asyncio
+from functools import wraps
+import os
+import time
+
+from aiohttp_session import get_session
+from asyncpg import create_pool as asyncpg_create_pool
+
+from molb.utils import get_dsn
+
+
+def pool_options(config):
+    """Return the options of the pool read from a [database] section"""
+    options = {
+        "min_size": config.getint("pool_min_size", fallback=2),
+        "max_size": config.getint("pool_max_size", fallback=10),
+        "max_inactive_connection_lifetime": config.getfloat("pool_max_inactive_lifetime", fallback=300),
+        "command_timeout": config.getfloat("command_timeout", fallback=None),
+        "statement_cache_size": config.getint("statement_cache_size", fallback=100)
+    }
+    if config.getboolean("pgbouncer", fallback=False):
+        # the prepared statements do not survive the transactions when
+        # pgbouncer shares the server connections between its clients
+        options["statement_cache_size"] = 0
+    return options
+
+
+def session_dsn(config):
+    """Return the connection string of the connections that need a session
+
+    The notifications and the advisory locks do not work through pgbouncer in
+    transaction mode, these connections go to session_host and session_port
+    when they are given.
+    """
+    return get_dsn(dict(
+        config,
+        host=config.get("session_host", config["host"]),
+        port=config.get("session_port", config["port"])
+    ))
+
+
+def session_options(config):
+    """Return the options of the connections that need a session"""
+    if config.getboolean("pgbouncer", fallback=False):
+        return {"statement_cache_size": 0}
+    return {}
+
+
+async def create_pool(config):
+    pool = await asyncpg_create_pool(dsn=get_dsn(config), **pool_options(config))
+    return InstrumentedPool(pool, config.getfloat("acquire_timeout", fallback=10))
+
+
+class AcquireContext:
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.acquire_connection(self.timeout)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        conn, self.conn = self.conn, None
+        await self.pool.release(conn)
+
+    def __await__(self):
+        return self.pool.acquire_connection(self.timeout).__await__()
+
+
+class InstrumentedPool:
+    """Pool of connections counting the waits for a connection
+
+    The connections are not acquired for more than timeout seconds. The other
+    methods are those of the asyncpg pool.
+    """
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.started_at = time.time()
+        self.acquired = 0
+        self.waiting = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.timeouts = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def acquire(self, *, timeout=None):
+        return AcquireContext(self, self.timeout if timeout is None else timeout)
+
+    async def acquire_connection(self, timeout):
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            conn = await self.pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+            wait_time = time.monotonic() - start
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.acquired += 1
+        return conn
+
+    async def release(self, conn):
+        await self.pool.release(conn)
+
+    def stats(self):
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started_at),
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "mean_wait_ms": round(1000 * self.wait_time / max(self.acquired + self.timeouts, 1), 3),
+            "max_wait_ms": round(1000 * self.max_wait_time, 3)
+        }
+
+
+def has_replica(app):
+    return app["db-replica-pool"] is not app["db-pool"]
+
+
+def replica_lag(app):
+    """Return the seconds during which the replica may not have the last writes"""
+    return app["config"].getfloat("database_replica", "max_lag", fallback=5)
+
+
+async def wrote(request):
+    """Read the writes of the session from the primary for a while"""
+    if has_replica(request.app):
+        session = await get_session(request)
+        session["last-write"] = time.time()
+
+
+def read_only(f):
+    """Run the queries of the view on the replica, when there is one
+
+    The sessions that have just written keep on reading from the primary, the
+    replica may not have their writes yet.
+    """
+    @wraps(f)
+    async def wrapped(request):
+        if has_replica(request.app):
+            session = await get_session(request)
+            elapsed = time.time() - session.get("last-write", 0)
+            request["replica"] = elapsed > replica_lag(request.app)
+        return await f(request)
+    return wrapped
+
+
+def db_pool(request):
+    """Return the pool the queries of the view are run on"""
+    if request.get("replica"):
+        return request.app["db-replica-pool"]
+    return request.app["db-pool"]
@@ -0,0 +1,49 @@
+import logging
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+FORM_CONTENT_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+def post_commit(request, function, *args):
+    """Call the coroutine function once the handler has returned
+
+    It must be registered once the transaction is committed. It is called
+    after the connections of the handler have been released back to the pool,
+    so slow side effects such as sending mails do not hold them.
+    """
+    request.setdefault("post-commit", []).append((function, args))
+
+
+async def post_commit_middleware(app, handler):
+    """Limit the time during which the handlers hold a database connection
+
+    The body of a posted form is read before the handler is called, so that
+    the handler does not wait for it with a connection held. The post commit
+    hooks registered by the handler are called when it has succeeded.
+    """
+    async def middleware_handler(request):
+        if request.method == "POST" and request.content_type in FORM_CONTENT_TYPES:
+            await request.post()
+
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            if e.status < 400:
+                await run_hooks(request)
+            raise
+        if response.status < 400:
+            await run_hooks(request)
+        return response
+    return middleware_handler
+
+
+async def run_hooks(request):
+    for function, args in request.get("post-commit", []):
+        try:
+            await function(*args)
+        except Exception:
+            logger.exception("post commit hook %s failed", function.__name__)
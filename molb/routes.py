@@ -1,5 +1,4 @@
-import os.path as op
-
+from molb.assets import STATIC_DIR
 from molb.views.auth import login
 from molb.views.auth import logout
 from molb.views.auth import switch
@@ -20,12 +19,21 @@ from molb.views.client import list_client
 from molb.views.client import toggle_client
 from molb.views.home import home
 from molb.views.mailing import mailing
+from molb.views.mailing import mailing_progress
+from molb.views.map import map_tile
+from molb.views.map import repository_markers
+from molb.views.map import repository_nearest
 from molb.views.language import language
 from molb.views.order import create_order
 from molb.views.order import edit_order
 from molb.views.order import delete_order
 from molb.views.order import list_order
+from molb.views.order import list_order_more
+from molb.views.outbox import list_outbox
+from molb.views.outbox import retry_outbox
+from molb.views.plan import export_plan
 from molb.views.plan import plan
+from molb.views.plan import plan_report
 from molb.views.product import create_product
 from molb.views.product import edit_product
 from molb.views.product import delete_product
@@ -34,16 +42,17 @@ from molb.views.repository import create_repository
 from molb.views.repository import edit_repository
 from molb.views.repository import delete_repository
 from molb.views.repository import list_repository
+from molb.views.stats import pool_stats
 from molb.views.unconfirmed import list_unconfirmed
 from molb.views.unconfirmed import delete_unconfirmed
 from molb.views.unconfirmed import send_unconfirmed
 
 
 def setup_routes(app):
-    development_mode = app["config"]["application"].get("development", False)
+    development_mode = app["config"].getboolean("application", "development", fallback=False)
     if development_mode:
-        static_dir = op.join(op.dirname(op.abspath(__file__)), "static")
-        app.router.add_static("/static", static_dir)
+        # also serves the fingerprinted files and their gzip variants
+        app.router.add_static("/static", STATIC_DIR)
 
     # auth
     app.router.add_route('*', "/", login, name="login")
@@ -68,6 +77,7 @@ def setup_routes(app):
     # client
     app.router.add_route('*', "/client/list/", list_client, name="list_client")
     app.router.add_route('*', "/client/mailing/", mailing, name="mailing")
+    app.router.add_get("/client/mailing/{id:\d+}/", mailing_progress, name="mailing_progress")
     app.router.add_get("/client/toggle/{id:\d+}/", toggle_client, name="toggle_client")
     app.router.add_get("/client/unconfirmed/list/", list_unconfirmed, name="list_unconfirmed")
     app.router.add_get("/client/unconfirmed/delete/{id:\d+}/", delete_unconfirmed, name="delete_unconfirmed")
@@ -80,14 +90,24 @@ def setup_routes(app):
     app.router.add_get("/lang/en/", language, name="en")
     app.router.add_get("/lang/fr/", language, name="fr")
 
+    # map
+    app.router.add_get("/map/tiles/{z:\d+}/{x:\d+}/{y:\d+}.png", map_tile, name="map_tile")
+
     # orders
     app.router.add_route('*', "/order/create/", create_order, name="create_order")
     app.router.add_get("/order/delete/{id:\d+}/", delete_order, name="delete_order")
     app.router.add_route('*', "/order/edit/{id:\d+}/", edit_order, name="edit_fill_order")
     app.router.add_get("/order/list/", list_order, name="list_order")
+    app.router.add_get("/order/list/more/", list_order_more, name="list_order_more")
+
+    # outbox
+    app.router.add_get("/outbox/", list_outbox, name="list_outbox")
+    app.router.add_get("/outbox/retry/{id:\d+}/", retry_outbox, name="retry_outbox")
 
     # plan
     app.router.add_route('*', "/plan/", plan, name="plan")
+    app.router.add_post("/plan/export/", export_plan, name="export_plan")
+    app.router.add_route('*', "/plan/report/", plan_report, name="plan_report")
 
     # products
     app.router.add_route('*', "/product/create/", create_product, name="create_product")
@@ -100,3 +120,8 @@ def setup_routes(app):
     app.router.add_get("/repository/delete/{id:\d+}/", delete_repository, name="delete_repository")
     app.router.add_route('*', "/repository/edit/{id:\d+}/", edit_repository, name="edit_repository")
     app.router.add_get("/repository/list/", list_repository, name="list_repository")
+    app.router.add_get("/repository/markers/", repository_markers, name="repository_markers")
+    app.router.add_get("/repository/nearest/", repository_nearest, name="repository_nearest")
+
+    # statistics
+    app.router.add_get("/stats/pool/", pool_stats, name="pool_stats")
@@ -0,0 +1,156 @@
+from functools import lru_cache
+import os
+import os.path as op
+
+from aiohttp_babel import locale
+from aiohttp_babel.locale import load_gettext_translations
+from aiohttp_babel.locale import set_default_locale
+from aiohttp_babel.middlewares import _
+from aiohttp_babel.middlewares import get_current_locale
+import aiohttp_jinja2
+from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import FileSystemLoader
+from jinja2 import ModuleLoader
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+from molb.assets import load_manifest
+from molb.assets import static_url
+from molb.catalog import LOCALES
+
+
+TEMPLATE_DIR = op.join(op.dirname(op.abspath(__file__)), "templates")
+
+
+def setup_i18n():
+    set_default_locale(LOCALES[0])
+    locales_dir = op.join(op.dirname(op.abspath(__file__)), "locales", "translations")
+    load_gettext_translations(locales_dir, "messages")
+    translate_for.cache_clear()
+
+
+def current_locale():
+    code = str(get_current_locale())
+    return code if code in LOCALES else LOCALES[0]
+
+
+@lru_cache(maxsize=None)
+def translate_for(code, message):
+    return locale.get(code).translate(message)
+
+
+def translate(message):
+    """Translate the message in the current locale, only once by locale"""
+    return translate_for(current_locale(), message)
+
+
+def split_locale(name):
+    """Return the locale and the name of the template without its prefix"""
+    code, sep, rest = name.partition("/")
+    if sep and code in LOCALES:
+        return code, rest
+    return None, name
+
+
+class LocaleLoader(FileSystemLoader):
+    """Load the templates of the directory once for each locale"""
+
+    def get_source(self, environment, template):
+        return super().get_source(environment, split_locale(template)[1])
+
+    def list_templates(self):
+        names = super().list_templates()
+        return sorted("{}/{}".format(code, name) for code in LOCALES for name in names)
+
+
+class LocaleEnvironment(Environment):
+    """Environment whose templates are compiled once for each locale
+
+    The templates rendered by the views are taken in the current locale, the
+    templates they extend, include or import are taken in the same locale.
+    """
+
+    def get_template(self, name, parent=None, globals=None):
+        if parent is None and isinstance(name, str) and split_locale(name)[0] is None:
+            name = "{}/{}".format(current_locale(), name)
+        return super().get_template(name, parent, globals)
+
+    def join_path(self, template, parent):
+        code = split_locale(parent)[0]
+        if code is not None and split_locale(template)[0] is None:
+            return "{}/{}".format(code, template)
+        return template
+
+
+class TranslationExtension(Extension):
+    """Replace the calls of _ on literal strings by their translation
+
+    The locale is the one of the template being compiled, so that rendering
+    it does not translate anything.
+    """
+
+    def filter_stream(self, stream):
+        code = split_locale(stream.name or "")[0]
+        tokens = list(stream)
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if (
+                code is not None and
+                token.type == "name" and token.value == "_" and
+                (i == 0 or tokens[i - 1].type != "dot") and
+                [t.type for t in tokens[i + 1:i + 4]] == ["lparen", "string", "rparen"]
+            ):
+                yield Token(token.lineno, "string", translate_for(code, tokens[i + 2].value))
+                i += 4
+            else:
+                yield token
+                i += 1
+
+
+# options of the environment the compiled templates depend on
+OPTIONS = {"autoescape": True, "extensions": [TranslationExtension]}
+
+
+def template_names():
+    return LocaleLoader(TEMPLATE_DIR).list_templates()
+
+
+def setup_templates(app, context_processors):
+    """Set up the jinja2 environment of the application
+
+    In production, the templates are not checked for modifications, they are
+    loaded from the modules built by tools/compile_templates.py or else
+    compiled through a bytecode cache shared by the workers. All of them are
+    loaded at startup, not on the first request that renders them.
+    """
+    config = app["config"]
+    production = not config.getboolean("application", "development", fallback=True)
+
+    loader = LocaleLoader(TEMPLATE_DIR)
+    options = dict(OPTIONS)
+    if production:
+        options["auto_reload"] = False
+        options["cache_size"] = -1
+        compiled_dir = config.get("templates", "compiled_dir", fallback="")
+        cache_dir = config.get("templates", "bytecode_cache_dir", fallback="")
+        if compiled_dir and op.isdir(compiled_dir):
+            loader = ModuleLoader(compiled_dir)
+        elif cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            options["bytecode_cache"] = FileSystemBytecodeCache(cache_dir)
+
+    # aiohttp_jinja2.setup cannot create an environment of another class, its
+    # environment is replaced after it has registered the context processors
+    aiohttp_jinja2.setup(app, context_processors=context_processors)
+    env = LocaleEnvironment(loader=loader, **options)
+    env.globals.update(aiohttp_jinja2.get_env(app).globals)
+    env.globals["_"] = _
+    env.globals["static"] = static_url(load_manifest())
+    app[aiohttp_jinja2.APP_KEY] = env
+
+    if production:
+        for name in template_names():
+            env.get_template(name)
+    return env
@@ -0,0 +1,198 @@
+import asyncio
+import fcntl
+import math
+import os
+import os.path as op
+import time
+
+import aiohttp
+
+
+USER_AGENT = "my-own-little-business tile cache"
+DEFAULT_URL = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+
+def tile_xy(lat, lon, zoom):
+    """Return the coordinates of the tile holding the position"""
+    n = 2 ** zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_around(lat, lon, radius, zoom):
+    """Return the tiles covering the square of radius km around the position"""
+    dlat = radius / 111.195
+    dlon = dlat / math.cos(math.radians(lat))
+    x0, y0 = tile_xy(lat + dlat, lon - dlon, zoom)
+    x1, y1 = tile_xy(lat - dlat, lon + dlon, zoom)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class TileCache:
+    """On disk cache of the map tiles fetched from an upstream tile server
+
+    A tile is kept ttl seconds after it has been fetched. The directory is
+    shared by all the workers and by tools/prefetch_tiles.py: the size limit
+    applies to the whole directory. Every time a process has written a
+    twentieth of max_size, it scans the directory and removes the least
+    recently used tiles, by access time, until the directory holds at most 90%
+    of max_size. A lock file keeps the other processes from scanning at the
+    same time. Concurrent requests of a tile that is not cached are served by
+    a single fetch. An expired tile is still served when the upstream server
+    fails.
+    """
+
+    # the access time of a served tile is updated at most once in this delay
+    atime_resolution = 60
+
+    def __init__(
+        self, directory, url, subdomains="abc", max_size=100 * 1024 * 1024,
+        ttl=7 * 86400, timeout=10
+    ):
+        self.directory = directory
+        self.url = url
+        self.subdomains = subdomains
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = None
+        # size of the directory at the last scan and bytes written since
+        self.size = 0
+        self.written = 0
+        self.fetches = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the cache described by the [map] section of the configuration"""
+        return cls(
+            config.get("map", "tile_cache_dir", fallback="/tmp/molb-tiles"),
+            config.get("map", "tile_url", fallback=DEFAULT_URL),
+            subdomains=config.get("map", "tile_subdomains", fallback="abc"),
+            max_size=config.getint("map", "tile_cache_size", fallback=100) * 1024 * 1024,
+            ttl=config.getint("map", "tile_ttl", fallback=7) * 86400
+        )
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": USER_AGENT}
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        await self.trim()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def scan(self):
+        """Return the access time, the path and the size of the tiles"""
+        tiles = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".png"):
+                    path = op.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        # removed by another process
+                        continue
+                    tiles.append((st.st_atime, path, st.st_size))
+        return tiles
+
+    def evict(self):
+        """Remove the least recently used tiles when the directory is too big
+
+        Return the size of the directory, or None when another process is
+        already doing it.
+        """
+        with open(op.join(self.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            tiles = self.scan()
+            size = sum(t[2] for t in tiles)
+            if size > self.max_size:
+                tiles.sort()
+                for _, path, tile_size in tiles:
+                    if size <= self.max_size * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    size -= tile_size
+            return size
+
+    async def trim(self):
+        self.written = 0
+        loop = asyncio.get_event_loop()
+        size = await loop.run_in_executor(None, self.evict)
+        if size is not None:
+            self.size = size
+
+    def path(self, z, x, y):
+        return op.join(self.directory, str(z), str(x), "{}.png".format(y))
+
+    def upstream_url(self, z, x, y):
+        s = self.subdomains[(x + y) % len(self.subdomains)] if self.subdomains else ""
+        return self.url.format(s=s, z=z, x=x, y=y)
+
+    def read(self, path):
+        """Return the tile and whether it has expired, or None"""
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+                st = os.fstat(f.fileno())
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if now - st.st_atime > self.atime_resolution:
+            # the access time orders the evictions, the modification time the
+            # expiration
+            try:
+                os.utime(path, (now, st.st_mtime))
+            except FileNotFoundError:
+                pass
+        return content, now - st.st_mtime > self.ttl
+
+    def write(self, path, content):
+        os.makedirs(op.dirname(path), exist_ok=True)
+        # the tile is replaced at once for the other workers
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, "wb") as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+
+    async def get(self, z, x, y):
+        path = self.path(z, x, y)
+        loop = asyncio.get_event_loop()
+        cached = await loop.run_in_executor(None, self.read, path)
+        if cached is not None and not cached[1]:
+            return cached[0]
+
+        fetch = self.fetches.get(path)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self.fetch(z, x, y, path))
+            self.fetches[path] = fetch
+            fetch.add_done_callback(lambda f: self.fetches.pop(path, None))
+        try:
+            # a cancelled request does not cancel the fetch awaited by others
+            return await asyncio.shield(fetch)
+        except Exception:
+            if cached is not None:
+                return cached[0]
+            raise
+
+    async def fetch(self, z, x, y, path):
+        async with self.session.get(self.upstream_url(z, x, y)) as response:
+            response.raise_for_status()
+            content = await response.read()
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.write, path, content)
+        self.written += len(content)
+        if self.written > self.max_size / 20:
+            await self.trim()
+        return content
@@ -22,3 +22,12 @@ def write_configuration_file(config):
 
     with open(conf_filename, "w") as f:
         config.write(f)
+
+
+def get_dsn(config):
+    """Return the connection string of the [database] section"""
+    return "postgres://{}:{}@{}:{}/{}".format(
+        config["username"], config["password"],
+        config["host"], config["port"],
+        config["database"]
+    )
@@ -40,7 +40,8 @@ async def login(request):
             login = form.login.data
             password = form.password.data
             db_pool = request.app["db-pool"]
-            if await check_credentials(db_pool, login, password):
+            hasher = request.app["hasher"]
+            if await check_credentials(db_pool, hasher, login, password):
                 async with request.app["db-pool"].acquire() as conn:
                     q = (
                         "UPDATE client SET last_seen = NOW() WHERE login = $1 "
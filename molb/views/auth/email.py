@@ -3,9 +3,10 @@ from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
-from aiohttp_security import authorized_userid
 
 from molb.auth import require
+from molb.auth.cache import client_changed
+from molb.post_commit import post_commit
 from molb.views.auth.email_form import EmailForm
 from molb.views.auth.token import get_token_data
 from molb.views.send_message import send_confirmation
@@ -16,49 +17,49 @@ from molb.views.utils import generate_csrf_meta
 @require("client")
 @aiohttp_jinja2.template("auth/email-email.html")
 async def handler(request):
-    login = await authorized_userid(request)
-    async with request.app["db-pool"].acquire() as conn:
-        q = "SELECT id, email_address FROM client WHERE login = $1"
-        client = await conn.fetchrow(q, login)
-
-        if request.method == "POST":
-            form = EmailForm(await request.post(), meta=await generate_csrf_meta(request))
+    client = request["client"]
+    if request.method == "POST":
+        form = EmailForm(await request.post(), meta=await generate_csrf_meta(request))
 
-            if form.validate():
-                data = dict(form.data.items())
-                email_address = data["email_address"]
+        if form.validate():
+            data = dict(form.data.items())
+            email_address = data["email_address"]
 
+            async with request.app["db-pool"].acquire() as conn:
                 q = "SELECT COUNT(*) FROM client WHERE email_address = $1"
-                if await conn.fetchval(q, email_address) != 0:
-                    flash(request, ("danger", _("Veuillez choisir une autre adresse email")))
-                    return {"form": form, "email": client["email_address"]}
+                count = await conn.fetchval(q, email_address)
+            if count != 0:
+                flash(request, ("danger", _("Veuillez choisir une autre adresse email")))
+                return {"form": form, "email": client["email_address"]}
 
-                await send_confirmation(
-                    request,
-                    email_address,
-                    {"id": client["id"], "email_address": email_address},
-                    "confirm_email",
-                    _("Changement d'adresse email"),
-                    "email-confirmation"
-                )
-                flash(
-                    request,
-                    (
-                        "info",
-                        _("Un email de confirmation a été envoyé à {}").format(
-                            email_address
-                        )
+            post_commit(
+                request,
+                send_confirmation,
+                request,
+                email_address,
+                {"id": client["id"], "email_address": email_address},
+                "confirm_email",
+                str(_("Changement d'adresse email")),
+                "email-confirmation"
+            )
+            flash(
+                request,
+                (
+                    "info",
+                    _("Un email de confirmation a été envoyé à {}").format(
+                        email_address
                     )
                 )
-                return HTTPFound(request.app.router["home"].url_for())
-            else:
-                flash(request, ("danger", _("Le formulaire contient des erreurs.")))
-            return {"form": form, "email": client["email_address"]}
-        elif request.method == "GET":
-            form = EmailForm(meta=await generate_csrf_meta(request))
-            return {"form": form, "email": client["email_address"]}
+            )
+            return HTTPFound(request.app.router["home"].url_for())
         else:
-            raise HTTPMethodNotAllowed()
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+        return {"form": form, "email": client["email_address"]}
+    elif request.method == "GET":
+        form = EmailForm(meta=await generate_csrf_meta(request))
+        return {"form": form, "email": client["email_address"]}
+    else:
+        raise HTTPMethodNotAllowed()
 
 
 async def confirm(request):
@@ -72,15 +73,17 @@ async def confirm(request):
         raise HTTPBadRequest()
 
     async with request.app["db-pool"].acquire() as conn:
-        q = "UPDATE client SET email_address = $1 WHERE id = $2"
+        q = "UPDATE client SET email_address = $1 WHERE id = $2 RETURNING login"
         try:
-            await conn.execute(q, email_address, id_)
+            async with conn.transaction():
+                login = await conn.fetchval(q, email_address, id_)
+                if login is not None:
+                    await client_changed(request, conn, login)
         except Exception:
             flash(request, ("danger", _("Votre adresse email ne peut pas être modifiée")))
         else:
             flash(request, ("info", _("Votre adresse email a été modifiée")))
-        login = await authorized_userid(request)
-        if login:
+        if request["client"] is not None:
             return HTTPFound(request.app.router["home"].url_for())
         else:
             return HTTPFound(request.app.router["login"].url_for())
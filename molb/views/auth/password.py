@@ -3,7 +3,6 @@ from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
-from passlib.hash import sha256_crypt
 from wtforms import PasswordField
 from wtforms import SubmitField
 from wtforms.validators import EqualTo
@@ -101,7 +100,7 @@ async def confirm(request):
     if request.method == "POST":
         form = PasswordForm(await request.post(), meta=await generate_csrf_meta(request))
         if form.validate():
-            password_hash = sha256_crypt.hash(form.password.data)
+            password_hash = await request.app["hasher"].hash(form.password.data)
 
             async with request.app["db-pool"].acquire() as conn:
                 q = "UPDATE client SET password_hash = $1 WHERE id = $2"
@@ -2,10 +2,8 @@ from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
-from aiohttp_security import authorized_userid
 from aiohttp_security import forget
 from asyncpg.exceptions import UniqueViolationError
-from passlib.hash import sha256_crypt
 from wtforms import BooleanField
 from wtforms import PasswordField
 from wtforms import SelectField
@@ -15,7 +13,9 @@ from wtforms.validators import EqualTo
 from wtforms.validators import Regexp
 
 from molb.auth import require
+from molb.auth.cache import client_changed
 from molb.views.csrf_form import CsrfForm
+from molb.views.order import add_batch_load
 from molb.views.utils import _l
 from molb.views.utils import flash
 from molb.views.utils import generate_csrf_meta
@@ -58,82 +58,97 @@ class ProfileForm(CsrfForm):
 @require("client")
 @aiohttp_jinja2.template("auth/profile.html")
 async def edit_profile(request):
-    async with request.app["db-pool"].acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT id, name, latitude, longitude FROM repository WHERE opened"
+    rows = await request.app["catalog"].repositories()
+    repository_choices = [(row["id"], row["name"]) for row in rows]
+
+    login = request["client"]["login"]
+    data = dict(request["client"])
+    if request.method == "POST":
+        form = ProfileForm(
+            await request.post(),
+            data=data,
+            meta=await generate_csrf_meta(request)
         )
-        repository_choices = [(row["id"], row["name"]) for row in rows]
-
-        login = await authorized_userid(request)
-        data = dict(await conn.fetchrow("SELECT * FROM client WHERE login = $1", login))
-        del data["password_hash"]
-        if request.method == "POST":
-            form = ProfileForm(
-                await request.post(),
-                data=data,
-                meta=await generate_csrf_meta(request)
+        form.repository_id.choices = repository_choices
+        if form.validate():
+            data = remove_special_data(form.data)
+            del data["password2"]
+            password = data.pop("password")
+            if password:
+                if len(password) < 6:
+                    flash(request, ("warning", _("Le mot de passe est trop court")))
+                    return {"form": form}
+                data["password_hash"] = await request.app["hasher"].hash(password)
+            q = "UPDATE client SET {} WHERE login = ${}".format(
+                settings(data), len(data) + 1
             )
-            form.repository_id.choices = repository_choices
-            if form.validate():
-                data = remove_special_data(form.data)
-                del data["password2"]
-                password = data.pop("password")
-                if password:
-                    if len(password) < 6:
-                        flash(request, ("warning", _("Le mot de passe est trop court")))
-                        return {"form": form}
-                    data["password_hash"] = sha256_crypt.hash(password)
-                q = "UPDATE client SET {} WHERE login = ${}".format(
-                    settings(data), len(data) + 1
-                )
-                try:
-                    await conn.execute(q, *data.values(), login)
-                except UniqueViolationError:
-                    flash(request, ("warning", _("Votre profil ne peut être modifié")))
-                else:
-                    flash(request, ("success", _("Votre profil a été modifié")))
-                    return HTTPFound(request.app.router["home"].url_for())
+            try:
+                async with request.app["db-pool"].acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute(q, *data.values(), login)
+                        # the plan summary is by repository of the clients, the
+                        # cached client may not have the current repository
+                        q = (
+                            "UPDATE plan_summary SET repository_id = $1 "
+                            "WHERE client_id = $2 AND repository_id != $1"
+                        )
+                        await conn.execute(q, data["repository_id"], request["client"]["id"])
+                        await client_changed(request, conn, login)
+            except UniqueViolationError:
+                flash(request, ("warning", _("Votre profil ne peut être modifié")))
             else:
-                flash(request, ("danger", _("Le formulaire contient des erreurs.")))
-            return {"form": form, "repositories": rows}
-        elif request.method == "GET":
-            form = ProfileForm(data=data, meta=await generate_csrf_meta(request))
-            form.repository_id.choices = repository_choices
-            return {"form": form, "repositories": rows}
+                flash(request, ("success", _("Votre profil a été modifié")))
+                return HTTPFound(request.app.router["home"].url_for())
         else:
-            raise HTTPMethodNotAllowed()
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+        return {"form": form}
+    elif request.method == "GET":
+        form = ProfileForm(data=data, meta=await generate_csrf_meta(request))
+        form.repository_id.choices = repository_choices
+        return {"form": form}
+    else:
+        raise HTTPMethodNotAllowed()
 
 
 @require("client")
 async def delete_profile(request):
-    login = await authorized_userid(request)
+    client = request["client"]
+    client_id = client["id"]
+    login = client["login"]
 
-    async with request.app["db-pool"].acquire() as conn:
-        client = await conn.fetchrow(
-            "SELECT id, super_user FROM client WHERE login = $1", login
-        )
-        client_id = client["id"]
-
-        if client["super_user"]:
-            flash(
-                request,
-                (
-                    "warning",
-                    _("Un administrateur ne peut pas supprimer son profil.")
-                )
+    if client["super_user"]:
+        flash(
+            request,
+            (
+                "warning",
+                _("Un administrateur ne peut pas supprimer son profil.")
             )
-            return HTTPFound(request.app.router["home"].url_for())
+        )
+        return HTTPFound(request.app.router["home"].url_for())
 
+    async with request.app["db-pool"].acquire() as conn:
         try:
             async with conn.transaction():
-                # delete associations between orders and products
-                q = "SELECT id FROM order_ WHERE client_id = $1"
+                # lock the orders before their batches, as the order edition
+                q = "SELECT id, batch_id, load FROM order_ WHERE client_id = $1 ORDER BY id FOR UPDATE"
                 orders = await conn.fetch(q, client_id)
                 order_ids = [order["id"] for order in orders]
 
+                # delete associations between orders and products
                 q = "DELETE FROM order_product_association WHERE order_id = any($1::int[])"
                 await conn.execute(q, order_ids)
 
+                # release the load of the locked orders in their batches
+                loads = {}
+                for order in orders:
+                    loads[order["batch_id"]] = loads.get(order["batch_id"], 0) + order["load"]
+                for batch_id in sorted(loads):
+                    await add_batch_load(conn, batch_id, -loads[batch_id])
+
+                # delete the products of the client from the plans
+                q = "DELETE FROM plan_summary WHERE client_id = $1"
+                await conn.execute(q, client_id)
+
                 # delete orders
                 q = "DELETE FROM order_ WHERE client_id = $1"
                 await conn.execute(q, client_id)
@@ -141,6 +156,7 @@ async def delete_profile(request):
                 # delete client
                 q = "DELETE FROM client WHERE id = $1"
                 await conn.execute(q, client_id)
+                await client_changed(request, conn, login)
         except Exception:
             flash(request, ("warning", _("Votre profil ne peut être supprimé")))
         else:
@@ -4,7 +4,6 @@ from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
 from asyncpg.exceptions import UniqueViolationError
-from passlib.hash import sha256_crypt
 from wtforms import BooleanField
 from wtforms import PasswordField
 from wtforms import SelectField
@@ -16,6 +15,9 @@ from wtforms.validators import Length
 from wtforms.validators import Regexp
 from wtforms.validators import DataRequired
 
+from molb.auth.cache import client_changed
+from molb.etag import table_changed
+from molb.post_commit import post_commit
 from molb.views.auth.token import get_token_data
 from molb.views.csrf_form import CsrfForm
 from molb.views.send_message import send_confirmation
@@ -84,65 +86,69 @@ class RegisterForm(CsrfForm):
 
 @aiohttp_jinja2.template("auth/register.html")
 async def handler(request):
-    async with request.app["db-pool"].acquire() as conn:
-        rows = await conn.fetch("SELECT id, name, latitude, longitude FROM repository WHERE opened")
-        repository_choices = [(row["id"], row["name"]) for row in rows]
+    rows = await request.app["catalog"].repositories()
+    repository_choices = [(row["id"], row["name"]) for row in rows]
 
-        if request.method == "POST":
-            form = RegisterForm(await request.post(), meta=await generate_csrf_meta(request))
-            form.repository_id.choices = repository_choices
-            if form.validate():
-                data = remove_special_data(form.data)
-                del data["password2"]
-                data["password_hash"] = sha256_crypt.hash(data.pop("password"))
+    if request.method == "POST":
+        form = RegisterForm(await request.post(), meta=await generate_csrf_meta(request))
+        form.repository_id.choices = repository_choices
+        if form.validate():
+            data = remove_special_data(form.data)
+            del data["password2"]
+            data["password_hash"] = await request.app["hasher"].hash(data.pop("password"))
+            q = "INSERT INTO client ({}) VALUES ({}) RETURNING *".format(
+                field_list(data), place_holders(data)
+            )
+            async with request.app["db-pool"].acquire() as conn:
                 try:
                     async with conn.transaction():
-                        q = "INSERT INTO client ({}) VALUES ({}) RETURNING *".format(
-                            field_list(data), place_holders(data)
-                        )
-                        try:
-                            client = await conn.fetchrow(q, *data.values())
-                        except UniqueViolationError:
-                            flash(
-                                request,
-                                (
-                                    "warning",
-                                    _(
-                                        "Votre profil ne peut être créé, cet "
-                                        "identifiant est déjà utilisé"
-                                    )
-                                )
-                            )
-                            raise  # rollback the transaction : client not created
-                        await send_confirmation(
-                            request,
-                            client["email_address"],
-                            {"id": client["id"]},
-                            "confirm_register",
-                            _("Confirmation de votre enregistrement"),
-                            "register-confirmation"
-                        )
-                        flash(
-                            request,
-                            (
-                                "info",
-                                _("Un email de confirmation a été envoyé à {}").format(
-                                    client["email_address"]
-                                )
+                        client = await conn.fetchrow(q, *data.values())
+                        await table_changed(request, conn, "client")
+                except UniqueViolationError:
+                    flash(
+                        request,
+                        (
+                            "warning",
+                            _(
+                                "Votre profil ne peut être créé, cet "
+                                "identifiant est déjà utilisé"
                             )
                         )
-                        return HTTPFound(request.app.router["login"].url_for())
+                    )
+                    return HTTPFound(request.app.router["register"].url_for())
                 except Exception:
                     return HTTPFound(request.app.router["register"].url_for())
-            else:
-                flash(request, ("danger", _("Le formulaire contient des erreurs.")))
-            return {"form": form, "repositories": rows}
-        elif request.method == "GET":
-            form = RegisterForm(meta=await generate_csrf_meta(request))
-            form.repository_id.choices = repository_choices
-            return {"form": form, "repositories": rows}
+
+            # the mail is sent once the connection is released
+            post_commit(
+                request,
+                send_confirmation,
+                request,
+                client["email_address"],
+                {"id": client["id"]},
+                "confirm_register",
+                str(_("Confirmation de votre enregistrement")),
+                "register-confirmation"
+            )
+            flash(
+                request,
+                (
+                    "info",
+                    _("Un email de confirmation a été envoyé à {}").format(
+                        client["email_address"]
+                    )
+                )
+            )
+            return HTTPFound(request.app.router["login"].url_for())
         else:
-            raise HTTPMethodNotAllowed()
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+        return {"form": form}
+    elif request.method == "GET":
+        form = RegisterForm(meta=await generate_csrf_meta(request))
+        form.repository_id.choices = repository_choices
+        return {"form": form}
+    else:
+        raise HTTPMethodNotAllowed()
 
 
 async def confirm(request):
@@ -156,11 +162,13 @@ async def confirm(request):
         raise HTTPBadRequest()
 
     async with request.app["db-pool"].acquire() as conn:
-        q = "UPDATE client SET confirmed = true WHERE id = $1 RETURNING id"
+        q = "UPDATE client SET confirmed = true WHERE id = $1 RETURNING login"
         try:
-            updated = await conn.fetchval(q, id_)
-            if updated is None:
-                raise
+            async with conn.transaction():
+                login = await conn.fetchval(q, id_)
+                if login is None:
+                    raise
+                await client_changed(request, conn, login)
         except Exception:
             flash(request, ("danger", _("Vous ne pouvez pas être enregistré.")))
             return HTTPFound(request.app.router["register"].url_for())
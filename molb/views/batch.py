@@ -13,6 +13,10 @@ from wtforms.validators import DataRequired
 from wtforms.validators import ValidationError
 
 from molb.auth import require
+from molb.catalog import catalog_changed
+from molb.etag import etag
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.csrf_form import CsrfForm
 from molb.views.utils import _l
 from molb.views.utils import flash
@@ -61,6 +65,7 @@ async def create_batch(request):
                     await conn.execute(
                         q, data["date"], data["capacity"], data["opened"]
                     )
+                    await catalog_changed(request, conn, "batch")
 
                 flash(request, ("success", _("La fournée a été créée")))
             except Exception:
@@ -81,6 +86,7 @@ async def delete_batch(request):
         try:
             async with conn.transaction():
                 await conn.execute("DELETE FROM batch WHERE id = $1", id_)
+                await catalog_changed(request, conn, "batch")
         except IntegrityConstraintViolationError:
             flash(request, ("warning", _("La fournée ne peut pas être supprimée")))
         except Exception:
@@ -117,6 +123,7 @@ async def edit_batch(request):
                 except IntegrityConstraintViolationError:
                     flash(request, ("warning", _("La fournée ne peut pas être modifiée")))
                 else:
+                    await catalog_changed(request, conn, "batch")
                     flash(request, ("success", _("La fournée a été modifiée")))
                     return HTTPFound(request.app.router["list_batch"].url_for())
             else:
@@ -129,10 +136,18 @@ async def edit_batch(request):
             raise HTTPMethodNotAllowed()
 
 
+async def next_batch(request):
+    """Return the date of the next batch, when it leaves the list"""
+    async with db_pool(request).acquire() as conn:
+        return await conn.fetchval("SELECT MIN(date) FROM batch WHERE date > NOW()")
+
+
 @require("admin")
+@read_only
+@etag("batch", until=next_batch)
 @aiohttp_jinja2.template("list-batch.html")
 async def list_batch(request):
-    async with request.app["db-pool"].acquire() as conn:
+    async with db_pool(request).acquire() as conn:
         q = (
             "SELECT CAST(id AS TEXT), date, capacity, opened "
             "FROM batch "
@@ -4,14 +4,20 @@ from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
 
 from molb.auth import require
+from molb.auth.cache import client_changed
+from molb.etag import etag
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.utils import flash
 
 
 @require("admin")
+@read_only
+@etag("client")
 @aiohttp_jinja2.template("list-client.html")
 async def list_client(request):
     if request.method == "GET":
-        async with request.app["db-pool"].acquire() as conn:
+        async with db_pool(request).acquire() as conn:
             q = (
                 "SELECT id, first_name, last_name, login, confirmed, disabled "
                 "FROM client "
@@ -28,7 +34,10 @@ async def list_client(request):
 async def toggle_client(request):
     client_id = int(request.match_info["id"])
     async with request.app["db-pool"].acquire() as conn:
-        q = "UPDATE client SET disabled = NOT disabled WHERE id = $1"
-        await conn.execute(q, client_id)
+        async with conn.transaction():
+            q = "UPDATE client SET disabled = NOT disabled WHERE id = $1 RETURNING login"
+            login = await conn.fetchval(q, client_id)
+            if login is not None:
+                await client_changed(request, conn, login)
     flash(request, ("success", _("Le statut du client a été modifié.")))
     return HTTPFound(request.app.router["list_client"].url_for())
@@ -1,5 +1,7 @@
 from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
+from aiohttp.web import HTTPNotFound
+from aiohttp.web import json_response
 import aiohttp_jinja2
 from aiohttp_babel.middlewares import _
 from wtforms import BooleanField
@@ -10,9 +12,9 @@ from wtforms import TextAreaField
 from wtforms.validators import DataRequired
 
 from molb.auth import require
+from molb.notify import notify
 from molb.views.csrf_form import CsrfForm
-from molb.views.send_message import send_mailing_message
-from molb.views.send_message import send_text_message
+from molb.views.send_message import CHANNEL
 from molb.views.utils import _l
 from molb.views.utils import flash
 from molb.views.utils import generate_csrf_meta
@@ -30,52 +32,53 @@ class MailingForm(CsrfForm):
 @require("admin")
 @aiohttp_jinja2.template("mailing.html")
 async def mailing(request):
-    async with request.app["db-pool"].acquire() as conn:
-        rows = await conn.fetch("SELECT id, name FROM repository WHERE opened")
-        repository_choices = [(row["id"], row["name"]) for row in rows]
+    rows = await request.app["catalog"].repositories()
+    repository_choices = [(row["id"], row["name"]) for row in rows]
 
-        if request.method == "POST":
-            form = MailingForm(await request.post(), meta=await generate_csrf_meta(request))
-            form.repository_id.choices = repository_choices
-            if form.validate():
-                data = remove_special_data(form.data)
-                subject = data["subject"]
-                message = data["message"]
-                if data["all_repositories"]:
-                    q = (
-                        "SELECT first_name, email_address, login FROM client "
-                        "WHERE confirmed AND mailing"
-                        )
-                    rows = await conn.fetch(q)
-                else:
-                    repository_id = data.get("repository_id")
+    if request.method == "POST":
+        form = MailingForm(await request.post(), meta=await generate_csrf_meta(request))
+        form.repository_id.choices = repository_choices
+        if form.validate():
+            data = remove_special_data(form.data)
+            config = request.app["config"]["application"]
+            subject = "[{}] {}".format(config["site_name"], data["subject"])
+            repository_id = None if data["all_repositories"] else data.get("repository_id")
+
+            # the recipients are expanded and the messages sent by the mailer
+            async with request.app["db-pool"].acquire() as conn:
+                async with conn.transaction():
                     q = (
-                        "SELECT first_name, email_address, login FROM client "
-                        "WHERE confirmed AND mailing AND repository_id = $1"
+                        "INSERT INTO mailing_job (subject, message, sender, repository_id) "
+                        "VALUES ($1, $2, $3, $4)"
                     )
-                    rows = await conn.fetch(q, repository_id)
-                if not rows:
-                    flash(request, ("warning", _("Il n'y a pas de destinataire.")))
-                    return HTTPFound(request.app.router["mailing"].url_for())
+                    await conn.execute(q, subject, data["message"], config["from"], repository_id)
+                    await notify(conn, CHANNEL)
+            flash(request, ("info", _("Les messages vont être envoyés.")))
+        else:
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+        return HTTPFound(request.app.router["mailing"].url_for())
 
-                if "<first_name>" in message or "<login>" in message:
-                    for r in rows:
-                        message_ = message.replace("<first_name>", r["first_name"])
-                        message_ = message_.replace("<login>", r["login"])
-                        await send_text_message(request, r["email_address"], subject, message_)
-                else:
-                    email_addresses = [r["email_address"] for r in rows]
-                    await send_mailing_message(request, email_addresses, subject, message)
-                flash(request, ("info", _("Les messages ont été envoyés.")))
-                return HTTPFound(request.app.router["mailing"].url_for())
-            else:
-                flash(request, ("danger", _("Le formulaire contient des erreurs.")))
-                return HTTPFound(request.app.router["mailing"].url_for())
+    elif request.method == "GET":
+        form = MailingForm(meta=await generate_csrf_meta(request))
+        form.repository_id.choices = repository_choices
+        async with request.app["db-pool"].acquire() as conn:
+            q = (
+                "SELECT id, subject, created_at, status, recipients, sent, failed "
+                "FROM mailing_job ORDER BY id DESC LIMIT 10"
+            )
+            jobs = await conn.fetch(q)
+        return {"form": form, "jobs": jobs}
 
-        elif request.method == "GET":
-            form = MailingForm(meta=await generate_csrf_meta(request))
-            form.repository_id.choices = repository_choices
-            return {"form": form}
+    else:
+        raise HTTPMethodNotAllowed()
 
-        else:
-            raise HTTPMethodNotAllowed()
+
+@require("admin")
+async def mailing_progress(request):
+    id_ = int(request.match_info["id"])
+    async with request.app["db-pool"].acquire() as conn:
+        q = "SELECT status, recipients, sent, failed FROM mailing_job WHERE id = $1"
+        job = await conn.fetchrow(q, id_)
+    if job is None:
+        raise HTTPNotFound()
+    return json_response(dict(job))
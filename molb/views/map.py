@@ -0,0 +1,93 @@
+from aiohttp.web import HTTPBadGateway
+from aiohttp.web import HTTPBadRequest
+from aiohttp.web import HTTPNotFound
+from aiohttp.web import json_response
+from aiohttp.web import Response
+
+from molb.geo import feature
+
+
+MAX_NEAREST = 10
+# size in pixels of the cells of the clusters, of the tiles of the map
+CLUSTER_PIXELS = 64
+TILE_PIXELS = 256
+
+
+def coordinate(value, limit):
+    """Return the latitude or longitude, within -limit and limit"""
+    value = float(value)
+    # also false for nan
+    if not -limit <= value <= limit:
+        raise ValueError(value)
+    return value
+
+
+def repository_feature(point, **properties):
+    return feature(
+        point["latitude"], point["longitude"], id=point["id"], name=point["name"], **properties
+    )
+
+
+async def repository_markers(request):
+    """Return the markers of the opened repositories of the viewport as GeoJSON
+
+    The bbox parameter holds the west, south, east and north limits. Below the
+    cluster_zoom of the [map] section, close repositories are grouped.
+    """
+    try:
+        west, south, east, north = request.query["bbox"].split(",")
+        west, east = coordinate(west, 180), coordinate(east, 180)
+        south, north = coordinate(south, 90), coordinate(north, 90)
+        zoom = int(request.query.get("zoom", 18))
+    except (KeyError, ValueError):
+        raise HTTPBadRequest()
+
+    config = request.app["config"]
+    zoom = min(max(zoom, 0), config.getint("map", "tile_max_zoom", fallback=19))
+    index = await request.app["repository-index"].get()
+    cluster_zoom = config.getint("map", "cluster_zoom", fallback=11)
+    features = []
+    if zoom < cluster_zoom:
+        cell_size = 360 / 2 ** zoom * CLUSTER_PIXELS / TILE_PIXELS
+        for lat, lon, points in index.clusters(south, west, north, east, cell_size):
+            if len(points) == 1:
+                features.append(repository_feature(points[0]))
+            else:
+                features.append(feature(lat, lon, cluster=True, count=len(points)))
+    else:
+        features = [repository_feature(p) for p in index.within(south, west, north, east)]
+    return json_response({"type": "FeatureCollection", "features": features})
+
+
+async def repository_nearest(request):
+    """Return the k opened repositories nearest to lat, lon as GeoJSON"""
+    try:
+        lat = coordinate(request.query["lat"], 90)
+        lon = coordinate(request.query["lon"], 180)
+        k = min(int(request.query.get("k", 3)), MAX_NEAREST)
+    except (KeyError, ValueError):
+        raise HTTPBadRequest()
+
+    index = await request.app["repository-index"].get()
+    features = [
+        repository_feature(point, distance=round(d, 2))
+        for d, point in index.nearest(lat, lon, max(k, 1))
+    ]
+    return json_response({"type": "FeatureCollection", "features": features})
+
+
+async def map_tile(request):
+    """Return a tile of the map from the tile cache"""
+    z, x, y = (int(request.match_info[k]) for k in ("z", "x", "y"))
+    max_zoom = request.app["config"].getint("map", "tile_max_zoom", fallback=19)
+    if z > max_zoom or x >= 2 ** z or y >= 2 ** z:
+        raise HTTPNotFound()
+
+    try:
+        content = await request.app["tile-cache"].get(z, x, y)
+    except Exception:
+        raise HTTPBadGateway()
+    return Response(
+        body=content, content_type="image/png",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
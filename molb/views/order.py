@@ -1,21 +1,27 @@
 from datetime import datetime
 from datetime import timedelta
 
+from aiohttp.web import HTTPBadRequest
 from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp_babel.middlewares import _
 from aiohttp_babel.middlewares import get_current_locale
 import aiohttp_jinja2
-from aiohttp_security import authorized_userid
 from wtforms import SelectField
 from wtforms import SubmitField
 
 from molb.auth import require
+from molb.etag import etag
+from molb.plan import add_plan_lines
+from molb.plan import order_changed
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.csrf_form import CsrfForm
 from molb.views.utils import _l
 from molb.views.utils import flash
 from molb.views.utils import generate_csrf_meta
 from molb.views.utils import remove_special_data
+from molb.views.utils import RollbackTransactionException
 
 
 class CreateOrderForm(CsrfForm):
@@ -27,101 +33,103 @@ class FillOrderForm(CsrfForm):
     submit = SubmitField(_l("Valider"))
 
 
-async def get_ordered_products_load(conn, batch_id, excluded=None):
-    """Return the load of already ordered products"""
+async def add_batch_load(conn, batch_id, load):
+    """Add the load to the batch, return False if it exceeds the batch capacity
+
+    Must be called in the transaction of the order, the row lock taken by the
+    update serializes the orders on the batch until the transaction ends.
+    """
+    q = (
+        "UPDATE batch SET load = load + $2 "
+        "WHERE id = $1 AND ($2 <= 0 OR load + $2 <= capacity) "
+        "RETURNING id"
+    )
+    return await conn.fetchval(q, batch_id, load) is not None
+
+
+def ordered_lines(products):
+    """Return the ordered quantities by product id"""
+    return {
+        product_id: product["ordered"]
+        for product_id, product in products.items() if product["ordered"] != 0
+    }
+
+
+def diff_order_lines(stored, ordered):
+    """Return the lines to insert, to update and the products to delete
+
+    Both arguments are quantities by product id.
+    """
+    inserted = {p: q for p, q in ordered.items() if p not in stored}
+    updated = {p: q for p, q in ordered.items() if p in stored and stored[p] != q}
+    deleted = [p for p in stored if p not in ordered]
+    return inserted, updated, deleted
+
+
+async def insert_order_lines(conn, order_id, lines):
+    q = (
+        "INSERT INTO order_product_association (quantity, order_id, product_id) "
+        "SELECT l.quantity, $1, l.product_id "
+        "FROM unnest($2::int[], $3::int[]) AS l(quantity, product_id)"
+    )
+    await conn.execute(q, order_id, list(lines.values()), list(lines.keys()))
 
-    # get summed quantities of all orders
-    if excluded is not None:
-        q = (
-            "SELECT SUM(quantity*p.load) AS load "
-            "FROM order_product_association "
-            "INNER JOIN order_ AS o ON o.id = order_id "
-            "INNER JOIN product AS p ON p.id = product_id "
-            "WHERE p.available AND o.batch_id = $1 AND order_id != $2"
-        )
-        load = await conn.fetchval(q, batch_id, excluded)
-    else:
-        q = (
-            "SELECT SUM(quantity*p.load) AS load "
-            "FROM order_product_association "
-            "INNER JOIN order_ AS o ON o.id = order_id "
-            "INNER JOIN product AS p ON p.id = product_id "
-            "WHERE p.available AND o.batch_id = $1"
-        )
-        load = await conn.fetchval(q, batch_id)
-    if load is None:
-        load = 0
-    return load
 
+async def update_order_lines(conn, order_id, lines):
+    q = (
+        "UPDATE order_product_association AS opa SET quantity = l.quantity "
+        "FROM unnest($2::int[], $3::int[]) AS l(quantity, product_id) "
+        "WHERE opa.order_id = $1 AND opa.product_id = l.product_id"
+    )
+    await conn.execute(q, order_id, list(lines.values()), list(lines.keys()))
 
-def products_for_context(rows, locale):
-    p = {}
-    for r in rows:
-        dct = dict(r)
-        n = dct.pop("name_lang1")
-        d = dct.pop("description_lang1")
-        if str(locale) == 'en':
-            dct["name"] = n
-            dct["description"] = d
-        p[dct["id"]] = dct
-    return p
+
+async def delete_order_lines(conn, order_id, product_ids):
+    q = (
+        "DELETE FROM order_product_association "
+        "WHERE order_id = $1 AND product_id = any($2::int[])"
+    )
+    await conn.execute(q, order_id, product_ids)
 
 
 @require("client")
 @aiohttp_jinja2.template("create-order.html")
 async def create_order(request):
-    login = await authorized_userid(request)
+    client = request["client"]
+    client_id = client["id"]
 
-    async with request.app["db-pool"].acquire() as conn:
-        q = (
-            "SELECT c.id, c.disabled, r.days "
-            "FROM client AS c "
-            "INNER JOIN repository AS r ON c.repository_id = r.id "
-            "WHERE c.login = $1 "
-        )
-        client = await conn.fetchrow(q, login)
-        client_id = client["id"]
+    if client["disabled"]:
+        flash(request, ("warning", _("Vous ne pouvez pas passer de commande.")))
+        return HTTPFound(request.app.router["list_order"].url_for())
 
-        if client["disabled"]:
-            flash(request, ("warning", _("Vous ne pouvez pas passer de commande.")))
-            return HTTPFound(request.app.router["list_order"].url_for())
+    # get all available products and opened batches
+    products = await request.app["catalog"].products(get_current_locale())
+    batches = await request.app["catalog"].batches()
+
+    async with request.app["db-pool"].acquire() as conn:
 
-        # select opened batches that have no order from the client
-        # select opened batches that have no order on them
-        # from all above selected batches, select batches :
+        # select opened batches :
         #    - whose date is 12 hours in the future
         #    - client's delivery days corresponds to the batch date
+        #    - that have no order from the client (index on order_(client_id, batch_id))
         q = (
-            "WITH batch_choices AS ( "
-            "    SELECT b.id AS batch_id, b.date AS batch_date_, c.id AS client_id FROM batch AS b "
-            "    LEFT JOIN order_ AS o ON b.id = o.batch_id "
-            "    LEFT JOIN client AS c ON c.id = o.client_id "
-            "    WHERE b.opened AND b.date > (NOW() + INTERVAL '12 hour') AND "
-            "          (string_to_array($2, ',')::BOOLEAN[])[EXTRACT(DOW FROM b.date) + 1] "
-            "    GROUP BY b.id, b.date, c.id "
-            "    ORDER BY b.id, b.date"
-            ") "
-            "SELECT DISTINCT batch_id, TO_CHAR(batch_date_::DATE, 'dd-mm-yyyy') AS batch_date "
-            "FROM batch_choices "
-            "WHERE batch_id NOT IN ("
-            "    SELECT batch_id FROM batch_choices "
-            "    WHERE client_id = $1"
-            ")"
+            "SELECT b.id AS batch_id, TO_CHAR(b.date::DATE, 'dd-mm-yyyy') AS batch_date "
+            "FROM batch AS b "
+            "WHERE b.opened AND b.date > (NOW() + INTERVAL '12 hour') AND "
+            "      $2::integer & (1 << EXTRACT(DOW FROM b.date)::integer) != 0 AND "
+            "      NOT EXISTS ("
+            "          SELECT 1 FROM order_ AS o "
+            "          WHERE o.client_id = $1 AND o.batch_id = b.id"
+            "      ) "
+            "ORDER BY b.date"
         )
-        rows = await conn.fetch(q, client_id, str(client["days"]).strip("[]"))
+        rows = await conn.fetch(q, client_id, client["days_mask"])
         batch_choices = [(row["batch_id"], row["batch_date"]) for row in rows]
 
         if not batch_choices:
             flash(request, ("warning", _("Il n'y a pas de fournée disponible.")))
             return HTTPFound(request.app.router["list_order"].url_for())
 
-        # get all available products
-        q = (
-            "SELECT * FROM product WHERE available"
-        )
-        rows = await conn.fetch(q)
-        products = products_for_context(rows, get_current_locale())
-
         template_context = {
             "products": products.values()
         }
@@ -139,14 +147,14 @@ async def create_order(request):
                 flash(request, ("danger", _("Le formulaire contient des erreurs.")))
                 return HTTPFound(request.app.router["list_order"].url_for())
 
-            # get the batch date and capacity
-            q = "SELECT date, capacity FROM batch WHERE id = $1"
-            row = await conn.fetchrow(q, batch_id)
-            batch_date = row["date"]
-            batch_capacity = row["capacity"]
+            # get the batch date
+            if batch_id not in batches:
+                flash(request, ("warning", _("Il n'y a pas de fournée disponible.")))
+                return HTTPFound(request.app.router["list_order"].url_for())
+            batch_date = batches[batch_id]["date"]
 
             # check that the batch corresponds to the delivery days
-            if not client["days"][(batch_date.weekday() + 1) % 7]:
+            if not client["days_mask"] & (1 << (batch_date.weekday() + 1) % 7):
                 flash(request, ("warning", _("La fournée choisie ne permet de vous livrer.")))
                 return HTTPFound(request.app.router["list_order"].url_for())
 
@@ -176,9 +184,27 @@ async def create_order(request):
                 flash(request, ("warning", _("Veuillez choisir au moins un produit")))
                 return template_context
 
-            # checked that the load of ordered products is less than the batch capacity
-            products_load = await get_ordered_products_load(conn, batch_id)
-            if total_load + products_load > batch_capacity:
+            try:
+                async with conn.transaction():
+                    # reserve the load of the order in the batch
+                    if not await add_batch_load(conn, batch_id, total_load):
+                        raise RollbackTransactionException()
+
+                    # create the order
+                    q = (
+                        "INSERT INTO order_ (total, load, client_id, batch_id) "
+                        "VALUES ($1, $2, $3, $4) RETURNING id"
+                    )
+                    order_id = await conn.fetchval(
+                        q, total_price, total_load, client_id, batch_id
+                    )
+
+                    # create order to products
+                    lines = ordered_lines(products)
+                    await insert_order_lines(conn, order_id, lines)
+                    await add_plan_lines(conn, batch_id, client["id"], lines)
+                    await order_changed(request, conn, batch_id)
+            except RollbackTransactionException:
                 flash(
                     request,
                     (
@@ -187,27 +213,6 @@ async def create_order(request):
                     )
                 )
                 return template_context
-
-            try:
-                async with conn.transaction():
-                    # create the order
-                    q = (
-                        "INSERT INTO order_ (total, client_id, batch_id) "
-                        "VALUES ($1, $2, $3) RETURNING id"
-                    )
-                    order_id = await conn.fetchval(q, total_price, client_id, batch_id)
-
-                    # create order to products
-                    for product_id, product in products.items():
-                        ordered = product["ordered"]
-                        if ordered != 0:
-                            q = (
-                                "INSERT INTO order_product_association ("
-                                "   quantity, order_id, product_id"
-                                ") "
-                                "VALUES ($1, $2, $3)"
-                            )
-                            await conn.execute(q, ordered, order_id, product_id)
             except Exception:
                 flash(request, ("warning", _("Votre commande n'a pas pu être passée.")))
                 return template_context
@@ -229,21 +234,17 @@ async def create_order(request):
 @aiohttp_jinja2.template("edit-order.html")
 async def edit_order(request):
     order_id = int(request.match_info["id"])
-    login = await authorized_userid(request)
+    client = request["client"]
+    client_id = client["id"]
 
-    async with request.app["db-pool"].acquire() as conn:
-        q = (
-            "SELECT c.id, c.disabled, r.days "
-            "FROM client AS c "
-            "INNER JOIN repository AS r ON c.repository_id = r.id "
-            "WHERE c.login = $1 "
-        )
-        client = await conn.fetchrow(q, login)
-        client_id = client["id"]
+    if client["disabled"]:
+        flash(request, ("warning", _("Vous ne pouvez pas modifier votre commande.")))
+        return HTTPFound(request.app.router["list_order"].url_for())
 
-        if client["disabled"]:
-            flash(request, ("warning", _("Vous ne pouvez pas modifier votre commande.")))
-            return HTTPFound(request.app.router["list_order"].url_for())
+    # get all available products
+    products = await request.app["catalog"].products(get_current_locale())
+
+    async with request.app["db-pool"].acquire() as conn:
 
         # check that the order belongs to the right client
         q = (
@@ -256,27 +257,19 @@ async def edit_order(request):
 
         # get batch id and batch date
         q = (
-            "SELECT batch_id, b.date, b.capacity FROM order_ AS o "
+            "SELECT batch_id, b.date FROM order_ AS o "
             "INNER JOIN batch AS b ON b.id = batch_id "
             "WHERE o.id = $1"
         )
         row = await conn.fetchrow(q, order_id)
         batch_date = row["date"]
         batch_id = row["batch_id"]
-        batch_capacity = row["capacity"]
 
         # check that's its not too late to modify the order
         if datetime.now() > batch_date - timedelta(hours=12):
             flash(request, ("warning", _("Il est trop tard pour modifier votre commande.")))
             return HTTPFound(request.app.router["list_order"].url_for())
 
-        # get all available products
-        q = (
-            "SELECT * FROM product WHERE available"
-        )
-        rows = await conn.fetch(q)
-        products = products_for_context(rows, get_current_locale())
-
         template_context = {
             "batch_date": batch_date,
             "batch_id": batch_id,
@@ -320,9 +313,51 @@ async def edit_order(request):
                 flash(request, ("warning", _("Veuillez choisir au moins un produit")))
                 return template_context
 
-            # checked that the load of ordered products is less than batch capacity
-            products_load = await get_ordered_products_load(conn, batch_id, excluded=order_id)
-            if total_load + products_load > batch_capacity:
+            # apply the modified lines of the order in a transaction
+            try:
+                async with conn.transaction():
+                    q = "SELECT load FROM order_ WHERE id = $1 FOR UPDATE"
+                    order_load = await conn.fetchval(q, order_id)
+
+                    q = (
+                        "SELECT product_id, quantity FROM order_product_association "
+                        "WHERE order_id = $1"
+                    )
+                    rows = await conn.fetch(q, order_id)
+                    stored = {r["product_id"]: r["quantity"] for r in rows}
+                    inserted, updated, deleted = diff_order_lines(
+                        stored, ordered_lines(products)
+                    )
+
+                    # when nothing has changed, the batch is not even locked
+                    if inserted or updated or deleted:
+                        # update the load reserved by the order in the batch
+                        delta = total_load - order_load
+                        if not await add_batch_load(conn, batch_id, delta):
+                            raise RollbackTransactionException()
+
+                        if deleted:
+                            await delete_order_lines(conn, order_id, deleted)
+                        if updated:
+                            await update_order_lines(conn, order_id, updated)
+                        if inserted:
+                            await insert_order_lines(conn, order_id, inserted)
+
+                        # the quantities added to or removed from the plan
+                        lines = dict(inserted)
+                        lines.update({p: q - stored[p] for p, q in updated.items()})
+                        lines.update({p: -stored[p] for p in deleted})
+                        await add_plan_lines(conn, batch_id, client["id"], lines)
+
+                        # update order total and load
+                        q = (
+                            "UPDATE order_ SET total = $1, load = $2, date=NOW() "
+                            "WHERE id = $3"
+                        )
+                        await conn.fetchval(q, total_price, total_load, order_id)
+                        await order_changed(request, conn, batch_id)
+
+            except RollbackTransactionException:
                 flash(
                     request,
                     (
@@ -331,34 +366,6 @@ async def edit_order(request):
                     )
                 )
                 return template_context
-
-            # delete and re-create the order in a transaction
-            try:
-                async with conn.transaction():
-                    # delete order to products association records
-                    q = "DELETE FROM order_product_association WHERE order_id = $1"
-                    await conn.execute(q, order_id)
-
-                    # and re-create them
-                    # create order to products
-                    for product_id, product in products.items():
-                        ordered = product["ordered"]
-                        if ordered != 0:
-                            q = (
-                                "INSERT INTO order_product_association ("
-                                "   quantity, order_id, product_id"
-                                ") "
-                                "VALUES ($1, $2, $3)"
-                            )
-                            await conn.execute(q, ordered, order_id, product_id)
-
-                    # update order total
-                    q = (
-                        "UPDATE order_ SET total = $1, date=NOW() "
-                        "WHERE id = $2"
-                    )
-                    await conn.fetchval(q, total_price, order_id)
-
             except Exception:
                 flash(request, ("warning", _("Votre commande n'a pas pu être modifiée.")))
                 return template_context
@@ -391,13 +398,9 @@ async def edit_order(request):
 @require("client")
 async def delete_order(request):
     order_id = int(request.match_info["id"])
-    login = await authorized_userid(request)
+    client_id = request["client"]["id"]
 
     async with request.app["db-pool"].acquire() as conn:
-        client_id = await conn.fetchval(
-            "SELECT id FROM client WHERE login = $1", login
-        )
-
         # get and batch date
         batch_date = await conn.fetchval(
             "SELECT b.date FROM order_ AS o "
@@ -411,42 +414,108 @@ async def delete_order(request):
         try:
             async with conn.transaction():
                 # needs to be deleted before the order
-                q = "DELETE FROM order_product_association WHERE order_id = $1"
-                await conn.execute(q, order_id)
+                q = (
+                    "DELETE FROM order_product_association WHERE order_id = $1 "
+                    "RETURNING product_id, quantity"
+                )
+                rows = await conn.fetch(q, order_id)
 
                 # delete and check that the order belongs to the right client
                 q = (
                     "DELETE FROM order_ "
-                    "WHERE id = $1 AND client_id = $2"
-                    "RETURNING id"
+                    "WHERE id = $1 AND client_id = $2 "
+                    "RETURNING batch_id, load"
                 )
-                id_ = await conn.fetchval(q, order_id, client_id)
-                if not id_:
+                order = await conn.fetchrow(q, order_id, client_id)
+                if not order:
                     raise
 
+                # release the load of the order in the batch
+                await add_batch_load(conn, order["batch_id"], -order["load"])
+
+                # remove the products of the order from the plan
+                lines = {r["product_id"]: -r["quantity"] for r in rows}
+                await add_plan_lines(conn, order["batch_id"], request["client"]["id"], lines)
+                await order_changed(request, conn, order["batch_id"])
+
                 flash(request, ("success", _("Votre commande a été supprimée.")))
         except Exception:
             flash(request, ("warning", _("Votre commande n'a pas pu être supprimée.")))
     return HTTPFound(request.app.router["list_order"].url_for())
 
 
-@require("client")
-@aiohttp_jinja2.template("list-order.html")
-async def list_order(request):
-    login = await authorized_userid(request)
+ORDERS_BY_PAGE = 20
 
-    async with request.app["db-pool"].acquire() as conn:
-        client = await conn.fetchrow(
-            "SELECT id, disabled FROM client WHERE login = $1", login
-        )
 
+async def get_orders(request, client_id):
+    """Return a page of the orders of the client and the url of the next one
+
+    The orders are sorted from the most recent batch and the page starts after
+    the (batch date, order id) cursor given in the query, if any. Each page
+    still reads and sorts all the orders of the client, found by the
+    order_(client_id, batch_id) index, but only sends the page.
+    """
+    cursor = request.query.get("date"), request.query.get("id")
+    if cursor != (None, None):
+        try:
+            cursor = datetime.strptime(cursor[0], "%Y-%m-%dT%H:%M:%S"), int(cursor[1])
+        except (TypeError, ValueError):
+            raise HTTPBadRequest()
+
+    async with db_pool(request).acquire() as conn:
         q = (
             "SELECT CAST(o.id AS TEXT), o.date AS order_date, o.total, "
             "       b.date AS batch_date, "
             "       b.date - INTERVAL '12 hour' AS cancellation_date "
             "FROM order_ AS o "
             "INNER JOIN batch AS b ON o.batch_id = b.id "
-            "WHERE o.client_id = $1 ORDER BY batch_date DESC"
+            "WHERE o.client_id = $1 AND "
+            "      ($2::timestamp IS NULL OR (b.date, o.id) < ($2::timestamp, $3::integer)) "
+            "ORDER BY b.date DESC, o.id DESC "
+            "LIMIT $4"
+        )
+        orders = await conn.fetch(q, client_id, *cursor, ORDERS_BY_PAGE + 1)
+
+    more_url = None
+    if len(orders) > ORDERS_BY_PAGE:
+        orders = orders[:ORDERS_BY_PAGE]
+        last = orders[-1]
+        more_url = request.app.router["list_order_more"].url_for().with_query(
+            date=last["batch_date"].strftime("%Y-%m-%dT%H:%M:%S"), id=last["id"]
         )
-        orders = await conn.fetch(q, client["id"])
-    return {"disabled": client["disabled"], "orders": orders, "now": datetime.now()}
+    return orders, more_url
+
+
+async def next_cancellation(request):
+    """Return the date after which the next order of the client cannot be changed"""
+    async with db_pool(request).acquire() as conn:
+        q = (
+            "SELECT MIN(b.date - INTERVAL '12 hour') "
+            "FROM order_ AS o "
+            "INNER JOIN batch AS b ON o.batch_id = b.id "
+            "WHERE o.client_id = $1 AND b.date - INTERVAL '12 hour' > $2"
+        )
+        return await conn.fetchval(q, request["client"]["id"], datetime.now())
+
+
+@require("client")
+@read_only
+@etag("order_", "batch", "client", until=next_cancellation)
+@aiohttp_jinja2.template("list-order.html")
+async def list_order(request):
+    client = request["client"]
+    orders, more_url = await get_orders(request, client["id"])
+    return {
+        "disabled": client["disabled"],
+        "orders": orders,
+        "more_url": more_url,
+        "now": datetime.now()
+    }
+
+
+@require("client")
+@read_only
+@aiohttp_jinja2.template("list-order-rows.html")
+async def list_order_more(request):
+    orders, more_url = await get_orders(request, request["client"]["id"])
+    return {"orders": orders, "more_url": more_url, "now": datetime.now()}
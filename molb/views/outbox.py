@@ -0,0 +1,50 @@
+from aiohttp.web import HTTPFound
+import aiohttp_jinja2
+from aiohttp_babel.middlewares import _
+
+from molb.auth import require
+from molb.notify import notify
+from molb.views.send_message import CHANNEL
+from molb.views.utils import flash
+
+
+@require("admin")
+@aiohttp_jinja2.template("outbox.html")
+async def list_outbox(request):
+    async with request.app["db-pool"].acquire() as conn:
+        q = (
+            "SELECT COUNT(*) FILTER (WHERE status = 'pending') AS pending, "
+            "       COUNT(*) FILTER (WHERE status = 'pending' AND attempts > 0) AS retried, "
+            "       COUNT(*) FILTER (WHERE status = 'dead') AS dead, "
+            "       COUNT(*) FILTER (WHERE sent_at > NOW() - INTERVAL '1 hour') AS sent_hour, "
+            "       COUNT(*) FILTER (WHERE sent_at > NOW() - INTERVAL '1 day') AS sent_day, "
+            "       MIN(created_at) FILTER (WHERE status = 'pending') AS oldest_pending "
+            "FROM outbox"
+        )
+        counters = await conn.fetchrow(q)
+
+        q = (
+            "SELECT id, recipients, attempts, last_error, created_at, next_attempt "
+            "FROM outbox WHERE status = 'dead' ORDER BY id DESC LIMIT 50"
+        )
+        dead = await conn.fetch(q)
+    return {"counters": counters, "dead": dead}
+
+
+@require("admin")
+async def retry_outbox(request):
+    id_ = int(request.match_info["id"])
+    async with request.app["db-pool"].acquire() as conn:
+        async with conn.transaction():
+            q = (
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = NOW() "
+                "WHERE id = $1 AND status = 'dead' "
+                "RETURNING job_id, cardinality(recipients) AS recipients"
+            )
+            row = await conn.fetchrow(q, id_)
+            if row is not None and row["job_id"] is not None:
+                q = "UPDATE mailing_job SET failed = failed - $2 WHERE id = $1"
+                await conn.execute(q, row["job_id"], row["recipients"])
+            await notify(conn, CHANNEL)
+    flash(request, ("success", _("Le message va être envoyé à nouveau.")))
+    return HTTPFound(request.app.router["list_outbox"].url_for())
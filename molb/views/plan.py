@@ -1,14 +1,24 @@
+import asyncio
+import csv
+from datetime import timedelta
+import io
+
 from aiohttp.web import HTTPFound
 from aiohttp.web import HTTPMethodNotAllowed
 from aiohttp.web import Response
+from aiohttp.web import StreamResponse
 from aiohttp_babel.middlewares import _
 import aiohttp_jinja2
 from multidict import MultiDict
 from wtforms import BooleanField
+from wtforms import DateField
 from wtforms import SelectField
 from wtforms import SubmitField
+from wtforms.validators import DataRequired
 
 from molb.auth import require
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.csrf_form import CsrfForm
 from molb.views.utils import _l
 from molb.views.utils import flash
@@ -22,16 +32,80 @@ class PlanForm(CsrfForm):
     submit = SubmitField(_l("Valider"))
 
 
+class ExportForm(CsrfForm):
+    start = DateField(
+        _l("Du"), format="%d/%m/%Y", validators=[DataRequired()],
+        render_kw={"placeholder": _l("jj/mm/aaaa")}
+    )
+    end = DateField(
+        _l("Au"), format="%d/%m/%Y", validators=[DataRequired()],
+        render_kw={"placeholder": _l("jj/mm/aaaa")}
+    )
+    submit = SubmitField(_l("Exporter"))
+
+
+class ReportForm(CsrfForm):
+    start = DateField(
+        _l("Du"), format="%d/%m/%Y", validators=[DataRequired()],
+        render_kw={"placeholder": _l("jj/mm/aaaa")}
+    )
+    end = DateField(
+        _l("Au"), format="%d/%m/%Y", validators=[DataRequired()],
+        render_kw={"placeholder": _l("jj/mm/aaaa")}
+    )
+    export = BooleanField(_l("Exporter"))
+    submit = SubmitField(_l("Valider"))
+
+
+# the number of products by repository by clients to make from the batches
+PLAN_DETAIL = (
+    "FROM plan_summary AS s "
+    "INNER JOIN product AS p ON s.product_id = p.id "
+    "INNER JOIN batch AS b ON s.batch_id = b.id "
+    "INNER JOIN client AS c ON s.client_id = c.id "
+    "INNER JOIN repository AS r ON s.repository_id = r.id "
+    "WHERE {} "
+    "ORDER BY b.date, r.name, c.last_name, c.first_name, p.name"
+)
+
+
+async def stream_csv(request, conn, q, *args):
+    """Write the rows of the query as they are fetched from a server side cursor"""
+    response = StreamResponse(
+        headers=MultiDict(
+            {
+                "Content-Disposition": "Attachment; filename=plan.csv",
+                "Content-Type": "text/csv; charset=utf-8"
+            }
+        )
+    )
+    await response.prepare(request)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    async with conn.transaction():
+        async for row in conn.cursor(q, *args):
+            writer.writerow(row)
+            if buffer.tell() >= 65536:
+                await response.write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+    await response.write(buffer.getvalue().encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
 @require("admin")
+@read_only
 @aiohttp_jinja2.template("plan.html")
 async def plan(request):
-    async with request.app["db-pool"].acquire() as conn:
+    async with db_pool(request).acquire() as conn:
         # select last 10 opened batches that have orders on them
         q = (
             "WITH sq AS ("
             "    SELECT DISTINCT b.id AS batch_id, b.date AS batch_date_ "
-            "    FROM order_ AS o "
-            "    INNER JOIN batch AS b ON o.batch_id = b.id "
+            "    FROM plan_summary AS s "
+            "    INNER JOIN batch AS b ON s.batch_id = b.id "
             "    WHERE b.opened "
             "    ORDER BY b.date DESC "
             "    LIMIT 10"
@@ -40,119 +114,151 @@ async def plan(request):
             "FROM sq"
         )
         rows = await conn.fetch(q)
-        batch_choices = [(row["batch_id"], row["batch_date"]) for row in rows]
-
-        if request.method == "POST":
-            form = PlanForm(await request.post(), meta=await generate_csrf_meta(request))
-            form.batch_id.choices = batch_choices
-
-            data = remove_special_data(form.data)
-            batch_id = int(data["batch_id"])
-
-            # just for csrf !
-            if not form.validate():
-                flash(request, ("danger", _("Le formulaire contient des erreurs.")))
-                return HTTPFound(request.app.router["plan"].url_for())
-
-            if data["export"]:
-                # get the number of products by repository by clients to make from the batch
-                q = (
-                    "SELECT r.name AS repository_name, c.last_name, c.first_name,"
-                    "       p.name AS product_name, "
-                    "       CAST(SUM(opa.quantity) AS TEXT) AS quantity "
-                    "FROM order_product_association AS opa "
-                    "INNER JOIN product AS p ON opa.product_id = p.id "
-                    "INNER JOIN order_ AS o ON opa.order_id = o.id "
-                    "INNER JOIN batch AS b ON o.batch_id = b.id "
-                    "INNER JOIN client AS c ON o.client_id = c.id "
-                    "INNER JOIN repository AS r ON c.repository_id = r.id "
-                    "WHERE b.id = $1 "
-                    "GROUP BY r.id, c.id, p.id "
-                    "ORDER BY r.name, c.last_name, c.first_name, p.name"
-                )
-                rows = await conn.fetch(q, batch_id)
-
-                body = ""
-                for r in rows:
-                    body += ','.join(r) + '\n'
-
-                return Response(
-                    headers=MultiDict(
-                        {
-                            "Content-Disposition": "Attachment; filename=plan.csv",
-                            "Content-Type": "text/csv"
-                        }
-                    ),
-                    body=body
-                )
-            else:
-                # get the number of products to make from the batch
-                q = (
-                    "SELECT p.name, SUM(opa.quantity) AS quantity "
-                    "FROM order_product_association AS opa "
-                    "INNER JOIN order_ AS o ON opa.order_id = o.id "
-                    "INNER JOIN product AS p ON opa.product_id = p.id "
-                    "INNER JOIN batch AS b ON o.batch_id = b.id "
-                    "WHERE b.id = $1 "
-                    "GROUP BY p.id"
-                )
-                products = await conn.fetch(q, batch_id)
-
-                # compute batch load
-                q = (
-                    "SELECT b.id, b.capacity, SUM(opa.quantity * p.load) AS load "
-                    "FROM order_product_association AS opa "
-                    "INNER JOIN product AS p ON opa.product_id = p.id "
-                    "INNER JOIN order_ AS o ON opa.order_id = o.id "
-                    "INNER JOIN batch AS b ON o.batch_id = b.id "
-                    "WHERE b.id = $1 "
-                    "GROUP BY b.id"
-                )
-                batch = await conn.fetchrow(q, batch_id)
-
-                # get the number of products by repository to make from the batch
-                q = (
-                    "SELECT r.name AS repository_name, p.name AS product_name, "
-                    "       SUM(opa.quantity) AS quantity "
-                    "FROM order_product_association AS opa "
-                    "INNER JOIN product AS p ON opa.product_id = p.id "
-                    "INNER JOIN order_ AS o ON opa.order_id = o.id "
-                    "INNER JOIN batch AS b ON o.batch_id = b.id "
-                    "INNER JOIN client AS c ON o.client_id = c.id "
-                    "INNER JOIN repository AS r ON c.repository_id = r.id "
-                    "WHERE b.id = $1 "
-                    "GROUP BY r.id, p.id "
-                    "ORDER BY r.name, p.name"
-                )
-                products_by_repository = await conn.fetch(q, batch_id)
-
-                # get the number of products by repository by clients to make from the batch
-                q = (
-                    "SELECT r.name AS repository_name, c.last_name, c.first_name,"
-                    "       p.name AS product_name, SUM(opa.quantity) AS quantity "
-                    "FROM order_product_association AS opa "
-                    "INNER JOIN product AS p ON opa.product_id = p.id "
-                    "INNER JOIN order_ AS o ON opa.order_id = o.id "
-                    "INNER JOIN batch AS b ON o.batch_id = b.id "
-                    "INNER JOIN client AS c ON o.client_id = c.id "
-                    "INNER JOIN repository AS r ON c.repository_id = r.id "
-                    "WHERE b.id = $1 "
-                    "GROUP BY r.id, c.id, p.id "
-                    "ORDER BY r.name, c.last_name, c.first_name, p.name"
-                )
-                products_by_repository_by_client = await conn.fetch(q, batch_id)
-
-                return {
-                    "form": form,
-                    "batch": batch,
-                    "products": products,
-                    "products_by_repository": products_by_repository,
-                    "products_by_repository_by_client": products_by_repository_by_client,
-                }
-
-        elif request.method == "GET":
-            form = PlanForm(meta=await generate_csrf_meta(request))
-            form.batch_id.choices = batch_choices
-            return {"form": form}
+    batch_choices = [(row["batch_id"], row["batch_date"]) for row in rows]
+
+    if request.method == "POST":
+        form = PlanForm(await request.post(), meta=await generate_csrf_meta(request))
+        form.batch_id.choices = batch_choices
+
+        data = remove_special_data(form.data)
+        batch_id = int(data["batch_id"])
+
+        # just for csrf !
+        if not form.validate():
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+            return HTTPFound(request.app.router["plan"].url_for())
+
+        if data["export"]:
+            q = (
+                "SELECT r.name, c.last_name, c.first_name, p.name, s.quantity " +
+                PLAN_DETAIL.format("b.id = $1")
+            )
+            async with db_pool(request).acquire() as conn:
+                return await stream_csv(request, conn, q, batch_id)
         else:
-            raise HTTPMethodNotAllowed()
+            # all the levels of the plan are computed from a single fetch, on
+            # the primary as the plan is cached until an order changes
+            async with request.app["db-pool"].acquire() as conn:
+                plan = await request.app["plan-cache"].get(conn, batch_id)
+            return {
+                "form": form,
+                "export_form": ExportForm(meta=await generate_csrf_meta(request)),
+                "batch": plan["batch"],
+                "products": plan["products"],
+                "products_by_repository": plan["products_by_repository"],
+                "products_by_repository_by_client": plan["products_by_repository_by_client"],
+            }
+
+    elif request.method == "GET":
+        form = PlanForm(meta=await generate_csrf_meta(request))
+        form.batch_id.choices = batch_choices
+        return {
+            "form": form,
+            "export_form": ExportForm(meta=await generate_csrf_meta(request))
+        }
+    else:
+        raise HTTPMethodNotAllowed()
+
+
+@require("admin")
+@read_only
+async def export_plan(request):
+    form = ExportForm(await request.post(), meta=await generate_csrf_meta(request))
+    if not form.validate() or form.end.data < form.start.data:
+        flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+        return HTTPFound(request.app.router["plan"].url_for())
+
+    async with db_pool(request).acquire() as conn:
+        # the batches delivered from the start day to the end day included
+        q = (
+            "SELECT TO_CHAR(b.date, 'dd-mm-yyyy'), r.name, c.last_name, c.first_name, "
+            "       p.name, s.quantity " +
+            PLAN_DETAIL.format("b.date >= $1 AND b.date < $2")
+        )
+        return await stream_csv(
+            request, conn, q, form.start.data, form.end.data + timedelta(days=1)
+        )
+
+
+async def get_plans(request, batch_ids):
+    """Return the plans of the batches, computed concurrently on several connections"""
+    concurrency = request.app["config"].getint("plan", "report_concurrency", fallback=4)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_plan(batch_id):
+        async with semaphore:
+            async with request.app["db-pool"].acquire() as conn:
+                return await request.app["plan-cache"].get(conn, batch_id)
+
+    return await asyncio.gather(*[get_plan(batch_id) for batch_id in batch_ids])
+
+
+def report_products(batches, plans):
+    """Return the product names and their quantities by product for each batch"""
+    quantities = {}
+    for n, plan in enumerate(plans):
+        for product in plan["products"]:
+            quantities.setdefault(product["name"], [0] * len(batches))[n] = product["quantity"]
+    return sorted(quantities.items())
+
+
+def report_csv(batches, plans):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([""] + [b["date"].strftime("%d-%m-%Y") for b in batches])
+    for name, quantities in report_products(batches, plans):
+        writer.writerow([name] + quantities)
+    writer.writerow([_("Charge")] + [plan["load"] for plan in plans])
+    writer.writerow([_("Capacité")] + [b["capacity"] for b in batches])
+    return Response(
+        headers=MultiDict(
+            {
+                "Content-Disposition": "Attachment; filename=report.csv",
+                "Content-Type": "text/csv; charset=utf-8"
+            }
+        ),
+        body=buffer.getvalue().encode("utf-8")
+    )
+
+
+@require("admin")
+@read_only
+@aiohttp_jinja2.template("plan-report.html")
+async def plan_report(request):
+    if request.method == "POST":
+        form = ReportForm(await request.post(), meta=await generate_csrf_meta(request))
+        if not form.validate() or form.end.data < form.start.data:
+            flash(request, ("danger", _("Le formulaire contient des erreurs.")))
+            return {"form": form}
+
+        async with db_pool(request).acquire() as conn:
+            # the batches delivered from the start day to the end day included
+            q = (
+                "SELECT id, date, capacity FROM batch "
+                "WHERE date >= $1 AND date < $2 ORDER BY date"
+            )
+            batches = await conn.fetch(q, form.start.data, form.end.data + timedelta(days=1))
+
+        max_batches = request.app["config"].getint("plan", "report_max_batches", fallback=31)
+        if len(batches) > max_batches:
+            flash(
+                request,
+                ("warning", _("La période comporte plus de {} fournées.").format(max_batches))
+            )
+            return {"form": form}
+
+        plans = await get_plans(request, [b["id"] for b in batches])
+
+        if form.export.data:
+            return report_csv(batches, plans)
+        return {
+            "form": form,
+            "batches": batches,
+            "plans": plans,
+            "products": report_products(batches, plans)
+        }
+    elif request.method == "GET":
+        form = ReportForm(meta=await generate_csrf_meta(request))
+        return {"form": form}
+    else:
+        raise HTTPMethodNotAllowed()
@@ -11,6 +11,10 @@ from wtforms.validators import Length
 from wtforms.validators import DataRequired
 
 from molb.auth import require
+from molb.catalog import catalog_changed
+from molb.etag import etag
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.csrf_form import CsrfForm
 from molb.views.utils import _l
 from molb.views.utils import field_list
@@ -75,6 +79,7 @@ async def create_product(request):
                 except IntegrityConstraintViolationError:
                     flash(request, ("warning", _("Le produit ne peut pas être créé")))
                     return {"form": form}
+                await catalog_changed(request, conn, "product")
             flash(request, ("success", _("Le produit a été créé")))
             return HTTPFound(request.app.router["list_product"].url_for())
         else:
@@ -96,6 +101,7 @@ async def delete_product(request):
         except IntegrityConstraintViolationError:
             flash(request, ("warning", _("Le produit ne peut pas être supprimé")))
         else:
+            await catalog_changed(request, conn, "product")
             flash(request, ("success", _("Le produit a été supprimé")))
         finally:
             return HTTPFound(request.app.router["list_product"].url_for())
@@ -123,6 +129,7 @@ async def edit_product(request):
                 except IntegrityConstraintViolationError:
                     flash(request, ("warning", _("Le produit ne peut pas être modifié")))
                 else:
+                    await catalog_changed(request, conn, "product")
                     flash(request, ("success", _("Le produit a été modifié")))
                     return HTTPFound(request.app.router["list_product"].url_for())
             else:
@@ -136,8 +143,10 @@ async def edit_product(request):
 
 
 @require("admin")
+@read_only
+@etag("product")
 @aiohttp_jinja2.template("list-product.html")
 async def list_product(request):
-    async with request.app["db-pool"].acquire() as conn:
+    async with db_pool(request).acquire() as conn:
         rows = await conn.fetch("SELECT CAST(id AS TEXT), name, available, price , load FROM product ORDER BY name")
     return {"products": rows}
@@ -12,6 +12,11 @@ from wtforms.validators import DataRequired
 from wtforms.validators import ValidationError
 
 from molb.auth import require
+from molb.auth.cache import client_changed
+from molb.catalog import catalog_changed
+from molb.etag import etag
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.csrf_form import CsrfForm
 from molb.views.utils import _l
 from molb.views.utils import array_to_days
@@ -78,6 +83,7 @@ async def create_repository(request):
                 except IntegrityConstraintViolationError:
                     flash(request, ("warning", _("Le point de livraison ne peut pas être créé")))
                     return {"form": form}
+                await catalog_changed(request, conn, "repository")
             flash(request, ("success", _("Le point de livraison a été créé")))
             return HTTPFound(request.app.router["list_repository"].url_for())
         else:
@@ -95,7 +101,10 @@ async def delete_repository(request):
     async with request.app["db-pool"].acquire() as conn:
         id_ = int(request.match_info["id"])
         try:
-            await conn.execute("DELETE FROM repository WHERE id = $1", id_)
+            async with conn.transaction():
+                await conn.execute("DELETE FROM repository WHERE id = $1", id_)
+                await client_changed(request, conn, None)
+                await catalog_changed(request, conn, "repository")
         except IntegrityConstraintViolationError:
             flash(request, ("warning", _("Le point de livraison ne peut pas être supprimé")))
         else:
@@ -124,7 +133,11 @@ async def edit_repository(request):
                     settings(data), len(data) + 1
                 )
                 try:
-                    await conn.execute(q, *data.values(), id_)
+                    async with conn.transaction():
+                        await conn.execute(q, *data.values(), id_)
+                        # the cached records hold the delivery days of the clients
+                        await client_changed(request, conn, None)
+                        await catalog_changed(request, conn, "repository")
                 except IntegrityConstraintViolationError:
                     flash(request, ("warning", _("Le point de livraison ne peut pas être modifié")))
                 else:
@@ -141,8 +154,10 @@ async def edit_repository(request):
 
 
 @require("admin")
+@read_only
+@etag("repository")
 @aiohttp_jinja2.template("list-repository.html")
 async def list_repository(request):
-    async with request.app["db-pool"].acquire() as conn:
+    async with db_pool(request).acquire() as conn:
         rows = await conn.fetch("SELECT CAST(id AS TEXT), name, opened FROM repository ORDER BY name")
     return {"repositories": rows}
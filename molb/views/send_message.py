@@ -1,22 +1,27 @@
 import asyncio
+from email import message_from_string
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+import logging
+import re
 
 from aiohttp_jinja2 import get_env
 from aiosmtplib import SMTP
+import asyncpg
 
+from molb.notify import notify
 from molb.views.auth.token import generate_token
 
 
-async def send_mailing_message(request, to, subject, text):
-    config = request.app["config"]
+logger = logging.getLogger(__name__)
 
-    message = MIMEText(text, "plain")
-    message["subject"] = "[{}] {}".format(config["application"]["site_name"], subject)
-    message["bcc"] = ','.join(to)
-    message["to"] = config["application"]["from"]
-    message["from"] = config["application"]["from"]
-    await request.app["mailer"].send_message(message, to)
+CHANNEL = "outbox"
+
+# key of the advisory lock held by the worker that sends the messages
+SENDER_LOCK = 0x6d6f6c62
+
+URGENT = 0
+MAILING = 1
 
 
 async def send_text_message(request, to, subject, text):
@@ -55,6 +60,86 @@ async def send_confirmation(
     await request.app["mailer"].send_urgent_message(message, email_address)
 
 
+# fields of the clients that can be inserted in the messages of a mailing
+PERSONALIZATION = re.compile("<(first_name|login)>")
+
+
+def compile_personalization(text):
+    """Return a function inserting the fields of a client in the text
+
+    Return None when the text has no field to insert.
+    """
+    parts = PERSONALIZATION.split(text)
+    if len(parts) == 1:
+        return None
+
+    # the field names are at the odd indexes
+    def render(client):
+        return "".join(client[part] if n % 2 else part for n, part in enumerate(parts))
+    return render
+
+
+async def expand_mailing_job(conn, chunk_size, max_recipients):
+    """Add the messages of the next recipients of a pending mailing job to the outbox
+
+    A personalized message is sent to each recipient, other messages are sent
+    to at most max_recipients recipients in BCC. Return False when there is no
+    pending job.
+    """
+    async with conn.transaction():
+        q = (
+            "SELECT * FROM mailing_job WHERE status = 'pending' "
+            "ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+        )
+        job = await conn.fetchrow(q)
+        if job is None:
+            return False
+
+        q = (
+            "SELECT id, first_name, email_address, login FROM client "
+            "WHERE confirmed AND mailing AND "
+            "      ($1::integer IS NULL OR repository_id = $1) AND id > $2 "
+            "ORDER BY id LIMIT $3"
+        )
+        clients = await conn.fetch(q, job["repository_id"], job["last_client_id"], chunk_size)
+
+        messages = []
+        render = compile_personalization(job["message"])
+        if render is not None:
+            for client in clients:
+                message = MIMEText(render(client), "plain")
+                message["subject"] = job["subject"]
+                message["to"] = client["email_address"]
+                message["from"] = job["sender"]
+                messages.append(([client["email_address"]], message))
+        else:
+            email_addresses = [client["email_address"] for client in clients]
+            for n in range(0, len(email_addresses), max_recipients):
+                to = email_addresses[n:n + max_recipients]
+                message = MIMEText(job["message"], "plain")
+                message["subject"] = job["subject"]
+                message["bcc"] = ','.join(to)
+                message["to"] = job["sender"]
+                message["from"] = job["sender"]
+                messages.append((to, message))
+
+        q = "INSERT INTO outbox (priority, recipients, message, job_id) VALUES ($1, $2, $3, $4)"
+        await conn.executemany(
+            q, [(MAILING, to, message.as_string(), job["id"]) for to, message in messages]
+        )
+
+        q = (
+            "UPDATE mailing_job "
+            "SET last_client_id = $2, recipients = recipients + $3, status = $4 "
+            "WHERE id = $1"
+        )
+        await conn.execute(
+            q, job["id"], clients[-1]["id"] if clients else job["last_client_id"],
+            len(clients), "pending" if len(clients) == chunk_size else "expanded"
+        )
+    return True
+
+
 class PriorityWrapper:
     def __init__(self, priority, obj):
         self.obj = obj
@@ -67,62 +152,284 @@ class PriorityWrapper:
         return "<PriorityWrapper priority={}, obj={}>".format(self.priority, repr(self.obj))
 
 
-class SmtpMailer:
-    def __init__(self, queue, delay, loop):
-        self.loop = loop
-        self.delay = delay
-        self.queue = queue
+class SmtpConnection:
+    """Connection to the SMTP relay, reused for several messages
 
-        self.smtp = SMTP(hostname="127.0.0.1", port=25)
+    The session is reset with RSET before each reused message, which also
+    checks that the connection is still alive. The connection is opened again
+    when this fails and after max_messages messages.
+    """
 
-        self.timer = None
-        self.task = asyncio.ensure_future(self.process_queue())
+    def __init__(self, smtp_options, max_messages):
+        self.smtp_options = smtp_options
+        self.max_messages = max_messages
+        self.smtp = None
+        self.messages = 0
 
     async def connect(self):
+        self.close()
+        self.smtp = SMTP(**self.smtp_options)
         await self.smtp.connect()
-
-    def deconnect(self):
-        self.smtp.close()
-        self.timer = None
-
-    async def smtp_send(self, msg, rcp):
-        await self.smtp.send_message(message=msg, recipients=rcp)
-
-    async def process_queue(self):
-        while True:
-            item = await self.queue.get()
-
-            if self.timer:
-                self.timer.cancel()
-                self.timer = self.loop.call_later(self.delay, self.deconnect)
-            else:
-                self.timer = self.loop.call_later(self.delay, self.deconnect)
-                await self.connect()
-
-            await self.smtp_send(item.obj["message"], item.obj["recipients"])
+        self.messages = 0
+
+    async def ready(self):
+        if self.smtp is None or not self.smtp.is_connected or \
+                self.messages >= self.max_messages:
+            await self.quit()
+            await self.connect()
+            return
+        try:
+            await self.smtp.rset()
+        except Exception:
+            await self.connect()
+
+    async def send(self, message, recipients):
+        await self.ready()
+        await self.smtp.send_message(message, recipients=recipients)
+        self.messages += 1
+
+    async def quit(self):
+        if self.smtp is not None and self.smtp.is_connected:
+            try:
+                await self.smtp.quit()
+            except Exception:
+                pass
+        self.close()
 
     def close(self):
-        if self.timer is not None:
-            self.timer.cancel()
-        self.task.cancel()
+        if self.smtp is not None:
+            self.smtp.close()
+            self.smtp = None
 
 
 class MassMailer:
-    def __init__(self, nbr_tasks=5, delay=30, loop=None):
-        loop = loop if loop is not None else asyncio.get_event_loop()
-
-        self.queue = asyncio.PriorityQueue(maxsize=4096)
-
-        self.mailers = []
-        for _ in range(nbr_tasks):
-            self.mailers.append(SmtpMailer(self.queue, delay, loop))
+    """Durable outbox of messages sent by a pool of SMTP connections
+
+    The messages are stored in the outbox table by all the workers. A single
+    worker, elected with an advisory lock, claims them by batches, urgent
+    messages first, and sends them with its SMTP connections. A claimed
+    message is leased for claim_timeout seconds, so that it is sent again if
+    the worker dies. A message that cannot be sent is tried again later with
+    an exponential backoff, then marked as dead after max_attempts attempts.
+
+    Each worker task of the pool owns a connection, which is closed after
+    idle_timeout seconds without message. A message that cannot be sent is
+    tried again once on a new connection: the workers never stop on an error.
+    """
+
+    def __init__(
+        self, db_pool, dsn, listener, host="127.0.0.1", port=25, use_tls=False,
+        start_tls=False, username=None, password=None, pool_size=5, max_messages=100,
+        idle_timeout=30, timeout=60, batch_size=50, max_attempts=5, retry_delay=60,
+        claim_timeout=300, poll_interval=10, keep_days=7, job_chunk=500, max_recipients=50,
+        connect_options=None
+    ):
+        self.db_pool = db_pool
+        # connection holding the lock of the sender
+        self.dsn = dsn
+        self.connect_options = connect_options or {}
+        self.listener = listener
+        self.smtp_options = {
+            "hostname": host,
+            "port": port,
+            "use_tls": use_tls,
+            "start_tls": start_tls,
+            "username": username,
+            "password": password,
+            "timeout": timeout
+        }
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.keep_days = keep_days
+        self.job_chunk = job_chunk
+        self.max_recipients = max_recipients
+
+        self.queue = asyncio.PriorityQueue()
+        self.wakeup = asyncio.Event()
+        self.elected = False
+
+        self.sent = 0
+        self.failures = 0
+        self.results = []
+
+        self.connections = []
+        self.workers = []
+        for _ in range(pool_size):
+            connection = SmtpConnection(self.smtp_options, max_messages)
+            self.connections.append(connection)
+            self.workers.append(asyncio.ensure_future(self.process_queue(connection)))
+        self.sender = None
+
+    async def start(self):
+        await self.listener.listen(CHANNEL, self.wake)
+        self.sender = asyncio.ensure_future(self.elect())
+
+    def wake(self, payload):
+        self.wakeup.set()
+
+    async def elect(self):
+        """Send the messages of the outbox as long as this worker holds the lock"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn, **self.connect_options)
+                if await conn.fetchval("SELECT pg_try_advisory_lock($1)", SENDER_LOCK):
+                    self.elected = True
+                    while not conn.is_closed():
+                        await self.send_outbox()
+                        # the recipients of the mailings are added by chunks
+                        # so that urgent messages are not delayed
+                        async with self.db_pool.acquire() as db_conn:
+                            if await expand_mailing_job(
+                                db_conn, self.job_chunk, self.max_recipients
+                            ):
+                                continue
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                        except asyncio.TimeoutError:
+                            pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("cannot send the messages of the outbox")
+            finally:
+                self.elected = False
+                if conn is not None:
+                    await conn.close()
+            await asyncio.sleep(self.poll_interval)
+
+    async def send_outbox(self):
+        """Send the messages that are due, by batches"""
+        while True:
+            self.wakeup.clear()
+            async with self.db_pool.acquire() as conn:
+                q = (
+                    "UPDATE outbox "
+                    "SET next_attempt = NOW() + $2 * INTERVAL '1 second', "
+                    "    attempts = attempts + 1 "
+                    "WHERE id IN ("
+                    "    SELECT id FROM outbox "
+                    "    WHERE status = 'pending' AND next_attempt <= NOW() "
+                    "    ORDER BY priority, id "
+                    "    LIMIT $1 "
+                    "    FOR UPDATE SKIP LOCKED"
+                    ") "
+                    "RETURNING id, priority, recipients, message"
+                )
+                rows = await conn.fetch(q, self.batch_size, self.claim_timeout)
+            if not rows:
+                break
+
+            self.results = []
+            for row in rows:
+                await self.queue.put(PriorityWrapper(row["priority"], row))
+            await self.queue.join()
+
+            sent = [id_ for id_, error in self.results if error is None]
+            failed = [(id_, error) for id_, error in self.results if error is not None]
+            async with self.db_pool.acquire() as conn:
+                async with conn.transaction():
+                    q = "UPDATE outbox SET status = 'sent', sent_at = NOW() WHERE id = any($1)"
+                    await conn.execute(q, sent)
+                    q = (
+                        "UPDATE outbox AS o SET last_error = f.error, "
+                        "    status = CASE WHEN o.attempts >= $3 THEN 'dead' ELSE 'pending' END, "
+                        "    next_attempt = NOW() + $4 * 2 ^ (o.attempts - 1) * INTERVAL '1 second' "
+                        "FROM unnest($1::int[], $2::text[]) AS f(id, error) "
+                        "WHERE o.id = f.id"
+                    )
+                    await conn.execute(
+                        q, [f[0] for f in failed], [f[1] for f in failed],
+                        self.max_attempts, self.retry_delay
+                    )
+
+                    # progress of the mailing jobs
+                    q = (
+                        "UPDATE mailing_job AS j "
+                        "SET sent = j.sent + s.sent, failed = j.failed + s.failed "
+                        "FROM ("
+                        "    SELECT job_id, "
+                        "           COALESCE(SUM(cardinality(recipients)) "
+                        "                    FILTER (WHERE status = 'sent'), 0) AS sent, "
+                        "           COALESCE(SUM(cardinality(recipients)) "
+                        "                    FILTER (WHERE status = 'dead'), 0) AS failed "
+                        "    FROM outbox "
+                        "    WHERE id = any($1) AND job_id IS NOT NULL "
+                        "    GROUP BY job_id"
+                        ") AS s "
+                        "WHERE j.id = s.job_id"
+                    )
+                    await conn.execute(q, [row["id"] for row in rows])
+
+        # the sent messages are kept for a while for the statistics
+        async with self.db_pool.acquire() as conn:
+            q = (
+                "DELETE FROM outbox "
+                "WHERE status = 'sent' AND sent_at < NOW() - $1 * INTERVAL '1 day'"
+            )
+            await conn.execute(q, self.keep_days)
+
+    async def process_queue(self, connection):
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                await connection.quit()
+                continue
+
+            row = item.obj
+            try:
+                message = message_from_string(row["message"])
+                try:
+                    await connection.send(message, row["recipients"])
+                except Exception:
+                    # the connection may have been closed by the relay
+                    connection.close()
+                    await connection.send(message, row["recipients"])
+                self.sent += 1
+                self.results.append((row["id"], None))
+            except Exception as e:
+                connection.close()
+                self.failures += 1
+                self.results.append((row["id"], repr(e)))
+                logger.exception("cannot send a message to %s", row["recipients"])
+            finally:
+                self.queue.task_done()
+
+    async def put(self, priority, msg, rcp):
+        if isinstance(rcp, str):
+            rcp = [rcp]
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                q = "INSERT INTO outbox (priority, recipients, message) VALUES ($1, $2, $3)"
+                await conn.execute(q, priority, rcp, msg.as_string())
+                await notify(conn, CHANNEL)
 
     async def send_urgent_message(self, msg, rcp):
-        await self.queue.put(PriorityWrapper(0, {"message": msg, "recipients": rcp}))
+        await self.put(URGENT, msg, rcp)
 
     async def send_message(self, msg, rcp):
-        await self.queue.put(PriorityWrapper(1, {"message": msg, "recipients": rcp}))
-
-    def close(self):
-        for mailer in self.mailers:
-            mailer.close()
+        await self.put(MAILING, msg, rcp)
+
+    def stats(self):
+        return {
+            "elected": self.elected,
+            "sent": self.sent,
+            "failures": self.failures,
+            "queue": self.queue.qsize(),
+            "connections": sum(
+                1 for c in self.connections if c.smtp is not None and c.smtp.is_connected
+            )
+        }
+
+    async def close(self):
+        tasks = self.workers + ([self.sender] if self.sender is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for connection in self.connections:
+            await connection.quit()
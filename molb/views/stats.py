@@ -0,0 +1,13 @@
+from aiohttp.web import json_response
+
+from molb.auth import require
+from molb.pool import has_replica
+
+
+@require("admin")
+async def pool_stats(request):
+    """Return the statistics of the pools of connections of the worker"""
+    stats = request.app["db-pool"].stats()
+    if has_replica(request.app):
+        stats["replica"] = request.app["db-replica-pool"].stats()
+    return json_response(stats)
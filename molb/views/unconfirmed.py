@@ -4,13 +4,17 @@ import aiohttp_jinja2
 from aiohttp_session_flash import flash
 
 from molb.auth import require
+from molb.etag import table_changed
+from molb.pool import db_pool
+from molb.pool import read_only
 from molb.views.send_message import send_confirmation
 
 
 @require("admin")
+@read_only
 @aiohttp_jinja2.template("list-unconfirmed.html")
 async def list_unconfirmed(request):
-    async with request.app["db-pool"].acquire() as conn:
+    async with db_pool(request).acquire() as conn:
         # select unconfirmed clients
         q = (
             "SELECT CAST(id AS TEXT), first_name, last_name, email_address, phone_number, created_at "
@@ -28,8 +32,10 @@ async def delete_unconfirmed(request):
     client_id = int(request.match_info["id"])
 
     async with request.app["db-pool"].acquire() as conn:
-        q = "DELETE FROM client WHERE id = $1 AND NOT confirmed"
-        await conn.execute(q, client_id)
+        async with conn.transaction():
+            q = "DELETE FROM client WHERE id = $1 AND NOT confirmed"
+            await conn.execute(q, client_id)
+            await table_changed(request, conn, "client")
 
     return HTTPFound(request.app.router["list_unconfirmed"].url_for())
 
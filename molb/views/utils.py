@@ -1,8 +1,9 @@
-from aiohttp_babel.middlewares import _
 from aiohttp_session_flash import flash as original_flash
 from aiohttp_session import get_session
 from babel.support import LazyProxy
 
+from molb.templating import translate
+
 
 DAYS = ("sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday")
 
@@ -28,9 +29,15 @@ def days_to_array(data):
     for d in DAYS:
         days.append(data.pop(d, False))
     data["days"] = days
+    data["days_mask"] = days_to_mask(days)
     return data
 
 
+def days_to_mask(days):
+    """Bit n of the mask is set when the day of week n (0 is sunday) is a delivery day"""
+    return sum(1 << n for n, day in enumerate(days) if day)
+
+
 async def generate_csrf_meta(request):
     return {
         "csrf_context": await get_session(request),
@@ -53,7 +60,7 @@ def settings(data):
 
 
 def lazy_gettext(s):
-    return LazyProxy(_, s, enable_cache=False)
+    return LazyProxy(translate, s, enable_cache=False)
 
 
 _l = lazy_gettext
@@ -13,7 +13,10 @@ setup(
 	packages=find_packages(),
 	include_package_data=True,
 	zip_safe=False,
-	license='AGPL'
+	license='AGPL',
+	entry_points={
+		'console_scripts': ['molb-migrate=molb.migrate:main'],
+	},
 )
 
 # http://python-packaging.readthedocs.io/en/latest/command-line-scripts.html
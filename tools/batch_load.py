@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""Verify the load counters of the orders and of the batches
+
+The counters are maintained by the order views. They must be recomputed
+after the load of an already ordered product has been modified.
+
+usage: batch_load.py [--repair]
+"""
+import asyncio
+import os
+import sys
+
+import asyncpg
+
+from molb.utils import get_dsn
+from molb.utils import read_configuration_file
+
+
+ORDER_LOADS = (
+    "SELECT o.id, o.load AS stored, COALESCE(SUM(opa.quantity * p.load), 0) AS computed "
+    "FROM order_ AS o "
+    "LEFT JOIN order_product_association AS opa ON opa.order_id = o.id "
+    "LEFT JOIN product AS p ON p.id = opa.product_id "
+    "GROUP BY o.id"
+)
+
+BATCH_LOADS = (
+    "SELECT b.id, b.load AS stored, COALESCE(SUM(opa.quantity * p.load), 0) AS computed "
+    "FROM batch AS b "
+    "LEFT JOIN order_ AS o ON o.batch_id = b.id "
+    "LEFT JOIN order_product_association AS opa ON opa.order_id = o.id "
+    "LEFT JOIN product AS p ON p.id = opa.product_id "
+    "GROUP BY b.id"
+)
+
+
+async def main(config, repair=False):
+    conn = await asyncpg.connect(get_dsn(config))
+
+    async with conn.transaction():
+        # prevent the orders from changing while the counters are computed
+        await conn.execute("LOCK TABLE batch, order_ IN EXCLUSIVE MODE")
+
+        errors = 0
+        for table, q in (("order_", ORDER_LOADS), ("batch", BATCH_LOADS)):
+            q = "SELECT * FROM ({}) AS l WHERE stored != computed".format(q)
+            for row in await conn.fetch(q):
+                errors += 1
+                print("{} {}: load = {}, should be {}".format(
+                    table, row["id"], row["stored"], row["computed"]
+                ))
+            if repair:
+                await conn.execute(
+                    "UPDATE {0} AS t SET load = l.computed FROM ({1}) AS l "
+                    "WHERE t.id = l.id AND l.stored != l.computed".format(table, q)
+                )
+
+    await conn.close()
+
+    if errors and not repair:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    config = read_configuration_file()
+    if not config:
+        sys.exit(1)
+    config = config["database"]
+    config["password"] = os.getenv("PG_PASS", "") or config["password"]
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(config, "--repair" in sys.argv[1:])))
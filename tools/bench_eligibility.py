@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""Compare the old and the new lookup of the batches a client can order on
+
+The tables are shadowed by temporary tables filled with generated orders, in
+a transaction that is rolled back: the data of the database is not modified.
+The median latency of both queries is printed for growing numbers of orders.
+
+usage: bench_eligibility.py [orders ...]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import asyncpg
+
+from molb.utils import get_dsn
+from molb.utils import read_configuration_file
+
+
+SIZES = (1000, 10000, 100000, 300000)
+BATCHES = 1000  # most of them are in the past
+OPENED_BATCHES = 20
+ORDERS_BY_CLIENT = 50
+RUNS = 20
+
+OLD = (
+    "WITH batch_choices AS ( "
+    "    SELECT b.id AS batch_id, b.date AS batch_date_, c.id AS client_id FROM batch AS b "
+    "    LEFT JOIN order_ AS o ON b.id = o.batch_id "
+    "    LEFT JOIN client AS c ON c.id = o.client_id "
+    "    WHERE b.opened AND b.date > (NOW() + INTERVAL '12 hour') AND "
+    "          (string_to_array($2, ',')::BOOLEAN[])[EXTRACT(DOW FROM b.date) + 1] "
+    "    GROUP BY b.id, b.date, c.id "
+    "    ORDER BY b.id, b.date"
+    ") "
+    "SELECT DISTINCT batch_id, TO_CHAR(batch_date_::DATE, 'dd-mm-yyyy') AS batch_date "
+    "FROM batch_choices "
+    "WHERE batch_id NOT IN ("
+    "    SELECT batch_id FROM batch_choices "
+    "    WHERE client_id = $1"
+    ")"
+)
+
+NEW = (
+    "SELECT b.id AS batch_id, TO_CHAR(b.date::DATE, 'dd-mm-yyyy') AS batch_date "
+    "FROM batch AS b "
+    "WHERE b.opened AND b.date > (NOW() + INTERVAL '12 hour') AND "
+    "      $2::integer & (1 << EXTRACT(DOW FROM b.date)::integer) != 0 AND "
+    "      NOT EXISTS ("
+    "          SELECT 1 FROM order_ AS o "
+    "          WHERE o.client_id = $1 AND o.batch_id = b.id"
+    "      ) "
+    "ORDER BY b.date"
+)
+
+
+async def create_tables(conn):
+    # temporary tables come first in the search path, the ids are given
+    # explicitly so that the sequences of the real tables are not used
+    for table in ("client", "batch", "order_"):
+        await conn.execute(
+            "CREATE TEMPORARY TABLE {0} (LIKE {0} INCLUDING ALL) ON COMMIT DROP".format(table)
+        )
+    await conn.execute(
+        "INSERT INTO batch (id, date, capacity, opened) "
+        "SELECT n, NOW() + (n - $1) * INTERVAL '1 day', 50, n > $1 "
+        "FROM generate_series(1, $2) AS n",
+        BATCHES - OPENED_BATCHES, BATCHES
+    )
+
+
+async def fill(conn, orders, size):
+    """Add orders up to size, each client ordering on different batches"""
+    await conn.execute(
+        "INSERT INTO client (id, login, password_hash, confirmed, first_name, last_name, "
+        "                    email_address, repository_id) "
+        "SELECT n, 'c' || n, '', true, 'c' || n, 'c' || n, 'c' || n, 1 "
+        "FROM generate_series((SELECT COALESCE(MAX(id), 0) + 1 FROM client), $1) AS n",
+        size // ORDERS_BY_CLIENT
+    )
+    await conn.execute(
+        "INSERT INTO order_ (id, total, client_id, batch_id) "
+        "SELECT n + 1, 0, n / $3 + 1, (n * 7919) % $4 + 1 "
+        "FROM generate_series($1, $2 - 1) AS n",
+        orders, size, ORDERS_BY_CLIENT, BATCHES
+    )
+    await conn.execute("ANALYZE client, batch, order_")
+
+
+async def measure(conn, q, *args):
+    latencies = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        await conn.fetch(q, *args)
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies) * 1000
+
+
+async def main(config, sizes):
+    conn = await asyncpg.connect(get_dsn(config))
+
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        await create_tables(conn)
+        print("{:>10} {:>12} {:>12}".format("orders", "old (ms)", "new (ms)"))
+        orders = 0
+        for size in sorted(sizes):
+            await fill(conn, orders, size)
+            orders = size
+            # a client who has ordered on some of the opened batches
+            client_id = await conn.fetchval(
+                "SELECT client_id FROM order_ AS o INNER JOIN batch AS b ON b.id = o.batch_id "
+                "WHERE b.opened LIMIT 1"
+            ) or 1
+            old = await measure(conn, OLD, client_id, "t,t,t,t,t,t,t")
+            new = await measure(conn, NEW, client_id, 127)
+            print("{:>10} {:>12.2f} {:>12.2f}".format(size, old, new))
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    config = read_configuration_file()
+    if not config:
+        sys.exit(1)
+    config = config["database"]
+    config["password"] = os.getenv("PG_PASS", "") or config["password"]
+
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(config, sizes)))
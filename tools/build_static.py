@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+"""Build the fingerprinted copies of the static files
+
+The copies are written in molb/static/build with their gzip (and brotli when
+the module is installed) compressed variants, and a manifest used by the
+static() helper of the templates. The copies of the previous build are kept
+for the pages still cached by the browsers. To be run after each update of the
+static files, then the application must be restarted.
+
+usage: build_static.py
+"""
+import sys
+
+from molb.assets import build_assets
+from molb.assets import BUILD_DIR
+
+
+def main():
+    manifest = build_assets()
+    print("{}: {} files".format(BUILD_DIR, len(manifest)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
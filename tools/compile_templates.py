@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+"""Compile the templates into python modules loaded by the application
+
+The modules are written in the directory given on the command line, or else
+in the compiled_dir of the [templates] section. They are loaded in production
+instead of the templates, which must be compiled again after each update of
+the templates or of the translations.
+
+usage: compile_templates.py [directory]
+"""
+import sys
+
+from molb.templating import LocaleEnvironment
+from molb.templating import LocaleLoader
+from molb.templating import OPTIONS
+from molb.templating import setup_i18n
+from molb.templating import TEMPLATE_DIR
+from molb.templating import template_names
+from molb.utils import read_configuration_file
+
+
+def main(target):
+    # the translations are compiled into the templates of each locale
+    setup_i18n()
+    env = LocaleEnvironment(loader=LocaleLoader(TEMPLATE_DIR), **OPTIONS)
+    env.compile_templates(target, zip=None, ignore_errors=False)
+    print("{}: {} templates".format(target, len(template_names())))
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        target = sys.argv[1]
+    else:
+        config = read_configuration_file()
+        if not config:
+            sys.exit(1)
+        target = config.get("templates", "compiled_dir", fallback="")
+        if not target:
+            sys.stderr.write("no compiled_dir in the [templates] section\n")
+            sys.exit(1)
+
+    sys.exit(main(target))
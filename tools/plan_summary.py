@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+"""Rebuild the summary of the production plans from the orders
+
+The summary is maintained by the order views. It must be rebuilt after its
+creation and after the load of an already ordered product has been modified.
+
+usage: plan_summary.py
+"""
+import asyncio
+import os
+import sys
+
+import asyncpg
+
+from molb.notify import notify
+from molb.plan import CHANNEL
+from molb.utils import get_dsn
+from molb.utils import read_configuration_file
+
+
+async def main(config):
+    conn = await asyncpg.connect(get_dsn(config))
+
+    async with conn.transaction():
+        # prevent the orders from changing while the summary is computed
+        await conn.execute("LOCK TABLE order_, plan_summary IN EXCLUSIVE MODE")
+
+        await conn.execute("DELETE FROM plan_summary")
+        status = await conn.execute(
+            "INSERT INTO plan_summary "
+            "    (batch_id, repository_id, client_id, product_id, quantity, load) "
+            "SELECT o.batch_id, c.repository_id, o.client_id, opa.product_id, "
+            "       SUM(opa.quantity), SUM(opa.quantity * p.load) "
+            "FROM order_product_association AS opa "
+            "INNER JOIN product AS p ON opa.product_id = p.id "
+            "INNER JOIN order_ AS o ON opa.order_id = o.id "
+            "INNER JOIN client AS c ON o.client_id = c.id "
+            "GROUP BY o.batch_id, c.repository_id, o.client_id, opa.product_id"
+        )
+        print("plan_summary: {} rows".format(status.split()[-1]))
+
+        # the plans cached by the workers are outdated
+        await notify(conn, CHANNEL)
+
+    await conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    config = read_configuration_file()
+    if not config:
+        sys.exit(1)
+    config = config["database"]
+    config["password"] = os.getenv("PG_PASS", "") or config["password"]
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(config)))
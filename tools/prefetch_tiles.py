@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""Fetch the tiles of the area of the map into the tile cache
+
+The area is the square of prefetch_radius km around the center of the [map]
+section, for the zoom levels from prefetch_min_zoom to prefetch_max_zoom.
+The tiles already cached and not expired are not fetched again.
+
+The tile server must allow bulk downloads: the usage policy of the
+openstreetmap.org servers forbids them, so the tool refuses to run against
+these servers.
+
+usage: prefetch_tiles.py
+"""
+import asyncio
+import sys
+from urllib.parse import urlsplit
+
+from molb.tiles import TileCache
+from molb.tiles import tiles_around
+from molb.utils import read_configuration_file
+
+
+# connections to the tile server
+CONCURRENCY = 2
+
+
+def bulk_download_forbidden(url):
+    host = urlsplit(url.replace("{s}", "a")).hostname or ""
+    return host == "openstreetmap.org" or host.endswith(".openstreetmap.org")
+
+
+async def main(config):
+    cache = TileCache.from_config(config)
+    if bulk_download_forbidden(cache.url):
+        sys.stderr.write(
+            "{}: the usage policy of the openstreetmap.org servers forbids bulk "
+            "downloads, set tile_url to your own tile server\n".format(cache.url)
+        )
+        return 1
+    await cache.start()
+
+    lat, lon = config.getfloat("map", "lat"), config.getfloat("map", "lon")
+    radius = config.getfloat("map", "prefetch_radius", fallback=5)
+    tiles = []
+    for zoom in range(
+        config.getint("map", "prefetch_min_zoom", fallback=10),
+        config.getint("map", "prefetch_max_zoom", fallback=16) + 1
+    ):
+        tiles.extend(tiles_around(lat, lon, radius, zoom))
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    failures = 0
+
+    async def fetch(tile):
+        nonlocal failures
+        async with semaphore:
+            try:
+                await cache.get(*tile)
+            except Exception as e:
+                failures += 1
+                sys.stderr.write("{}/{}/{}: {!r}\n".format(*tile, e))
+
+    await asyncio.gather(*(fetch(tile) for tile in tiles))
+    await cache.trim()
+    await cache.close()
+    print("{} tiles, {} failures, {} MB cached".format(
+        len(tiles), failures, cache.size // (1024 * 1024)
+    ))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    config = read_configuration_file()
+    if not config:
+        sys.exit(1)
+
+    loop = asyncio.get_event_loop()
+    sys.exit(loop.run_until_complete(main(config)))